@@ -0,0 +1,279 @@
+"""
+Benchmarks of the encoders and FCGR builders of complexcgr, on synthetic sequences.
+
+Each benchmark runs in its own process, so its peak memory (RSS) does not depend on the others.
+Results (throughput in bases per second, peak RSS and the startup cost of 'import complexcgr')
+are saved as json, to compare releases:
+
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --quick --output new.json --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+import statistics
+from pathlib import Path
+
+import numpy as np
+
+# benchmark the complexcgr of this checkout (also in the subprocesses)
+ROOT = str(Path(__file__).resolve().parents[1])
+sys.path.insert(0, ROOT)
+os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")]))
+
+# repeats of each benchmark, the best time is reported
+REPEATS = 3
+
+# # --------------- synthetic data ---------------- # #
+def random_sequence(length: int, seed: int = 42) -> str:
+    "uniform random sequence of A,C,G,T"
+    rng = np.random.default_rng(seed)
+    return np.frombuffer(b"ACGT", dtype=np.uint8)[rng.integers(0, 4, length)].tobytes().decode()
+
+def repeat_sequence(length: int, seed: int = 42) -> str:
+    """repeat-rich sequence: tandem copies of short units with 1% mutations, and runs of N's,
+    closer to the low complexity regions of real genomes"""
+    rng = np.random.default_rng(seed)
+    parts, total = [], 0
+    while total < length:
+        unit = random_sequence(int(rng.integers(2, 50)), seed=int(rng.integers(2**31)))
+        part = unit * int(rng.integers(5, 200))
+        if rng.random() < 0.05:
+            part += "N" * int(rng.integers(1, 100))
+        parts.append(part)
+        total += len(part)
+    seq = np.frombuffer("".join(parts)[:length].encode(), dtype=np.uint8).copy()
+    mutations = np.flatnonzero((rng.random(length) < 0.01) & (seq != ord("N")))
+    seq[mutations] = np.frombuffer(b"ACGT", dtype=np.uint8)[rng.integers(0, 4, len(mutations))]
+    return seq.tobytes().decode()
+
+SEQUENCES = {"random": random_sequence, "repeats": repeat_sequence}
+
+def write_fastq(path, n_reads: int, len_read: int, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    seq = random_sequence(n_reads*len_read, seed)
+    quals = (rng.integers(2, 41, n_reads*len_read) + 33).astype(np.uint8).tobytes().decode()
+    with open(path, "w") as fp:
+        for j in range(n_reads):
+            start = j*len_read
+            fp.write(f"@read{j}\n{seq[start:start+len_read]}\n+\n{quals[start:start+len_read]}\n")
+
+def write_dump(path, k: int, seed: int = 42):
+    "counts of all the k-mers, in the format of kmc_tools transform ... dump"
+    from itertools import product
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(1, 10_000, 4**k)
+    with open(path, "w") as fp:
+        fp.write("".join(f"{''.join(kmer)}\t{count}\n" for kmer, count in zip(product("ACGT", repeat=k), counts)))
+
+# # --------------- benchmarks ---------------- # #
+# each benchmark gets its parameters, prepares the input, and returns (function to time, number of bases processed)
+def bench_encoder(encoder: str, operation: str, length: int, sequence: str = "random"):
+    import complexcgr
+    codec = getattr(complexcgr, encoder)()
+    # encoders take only A,C,G,T: the runs of N's of repeat-rich sequences become runs of A's
+    seq = SEQUENCES[sequence](length).replace("N", "A")
+    if operation == "encode":
+        return lambda: codec.encode(seq), length
+    if operation == "trajectory":
+        return lambda: codec.trajectory(seq), length
+    coords = codec.encode(seq)
+    args = (coords.k, coords.N) if encoder == "ComplexCGR" else tuple(coords)
+    return lambda: codec.decode(*args), length
+
+def bench_encoder_many(encoder: str, operation: str, n_kmers: int, k: int = 31):
+    import complexcgr
+    codec = getattr(complexcgr, encoder)()
+    kmers = np.frombuffer(random_sequence(n_kmers*k).encode(), dtype=np.uint8).reshape(n_kmers, k)
+    if operation == "encode_many":
+        return lambda: codec.encode_many(kmers), n_kmers*k
+    coords = codec.encode_many(kmers)
+    coords = coords if isinstance(coords, tuple) else (coords,)
+    return lambda: codec.decode_many(*coords, k), n_kmers*k
+
+def bench_fcgr_init(k: int):
+    from complexcgr import FCGR
+    from complexcgr.fcgr import pixel_index
+    def run():
+        pixel_index.cache_clear()
+        FCGR(k)
+    return run, 0
+
+def bench_fcgr(k: int, length: int, sequence: str = "random", dtype: str = "float64", sparse: bool = False,
+               use_canonical_kmers: bool = False):
+    from complexcgr import FCGR
+    fcgr = FCGR(k, use_canonical_kmers=use_canonical_kmers, dtype=dtype, sparse=sparse)
+    seq = SEQUENCES[sequence](length)
+    return lambda: fcgr(seq), length
+
+def bench_fcgr_kmc(k: int, tmpdir: str):
+    from complexcgr import FCGRKmc
+    path = os.path.join(tmpdir, f"dump-{k}.txt")
+    write_dump(path, k)
+    fcgr = FCGRKmc(k)
+    return lambda: fcgr(path), 4**k * k
+
+def bench_fcgr_samples(k: int, n_reads: int, tmpdir: str, len_read: int = 150, consider_quality: bool = False,
+                       sample_fraction: float = None):
+    from complexcgr import FCGRSamples
+    path = os.path.join(tmpdir, f"reads-{n_reads}.fastq")
+    write_fastq(path, n_reads, len_read)
+    fcgr = FCGRSamples(k, sample_fraction=sample_fraction)
+    return lambda: fcgr(path, consider_quality=consider_quality), n_reads*len_read
+
+def bench_complexfcgr(k: int, length: int, size: int = 512, n_images: int = 1):
+    from complexcgr import ComplexFCGR
+    cfcgr = ComplexFCGR(k)
+    seqs = [random_sequence(length, seed) for seed in range(n_images)]
+    return lambda: cfcgr.render_sequences(seqs, size=size), length*n_images
+
+BENCHMARKS = {
+    "encoder": bench_encoder,
+    "encoder_many": bench_encoder_many,
+    "fcgr_init": bench_fcgr_init,
+    "fcgr": bench_fcgr,
+    "fcgr_kmc": bench_fcgr_kmc,
+    "fcgr_samples": bench_fcgr_samples,
+    "complexfcgr": bench_complexfcgr,
+}
+
+def suite(quick: bool = False):
+    "list of (benchmark, parameters)"
+    lengths = [1_000, 100_000] if quick else [1_000, 100_000, 1_000_000]
+    ks = [4, 8] if quick else list(range(4, 13))
+    tasks = []
+    for encoder, operations in (("CGR", ["encode", "trajectory"]), ("iCGR", ["encode", "decode"]),
+                                ("ComplexCGR", ["encode", "decode"])):
+        for operation in operations:
+            for length in lengths:
+                if encoder == "CGR" and operation == "encode" and length > 100_000:
+                    continue # one python float operation per base
+                for sequence in SEQUENCES:
+                    tasks.append(("encoder", dict(encoder=encoder, operation=operation, length=length, sequence=sequence)))
+        for operation in ("encode_many", "decode_many"):
+            tasks.append(("encoder_many", dict(encoder=encoder, operation=operation, n_kmers=10_000 if quick else 1_000_000)))
+    # CGR coordinates are floats: decode recovers at most ~53 nucleotides (the bits of a float64 mantissa)
+    tasks.append(("encoder", dict(encoder="CGR", operation="decode", length=50)))
+    length = 100_000 if quick else 1_000_000
+    for k in ks:
+        tasks.append(("fcgr_init", dict(k=k)))
+        for sequence in SEQUENCES:
+            tasks.append(("fcgr", dict(k=k, length=length, sequence=sequence)))
+    tasks.append(("fcgr", dict(k=ks[-1], length=length, use_canonical_kmers=True)))
+    tasks.append(("fcgr", dict(k=ks[-1], length=length, dtype="uint16", sparse=True)))
+    for k in ([4, 6] if quick else [4, 6, 8, 10]):
+        tasks.append(("fcgr_kmc", dict(k=k)))
+    n_reads = 1_000 if quick else 100_000
+    tasks.append(("fcgr_samples", dict(k=6, n_reads=n_reads)))
+    tasks.append(("fcgr_samples", dict(k=6, n_reads=n_reads, consider_quality=True)))
+    for sample_fraction in (0.1, 0.01):
+        tasks.append(("fcgr_samples", dict(k=8, n_reads=n_reads, sample_fraction=sample_fraction)))
+    tasks.append(("fcgr_samples", dict(k=8, n_reads=n_reads)))
+    tasks.append(("complexfcgr", dict(k=8, length=length)))
+    tasks.append(("complexfcgr", dict(k=6, length=10_000, size=128, n_images=16 if quick else 256)))
+    return tasks
+
+def peak_rss_mb() -> float:
+    "peak resident memory of this process (ru_maxrss is in KB on Linux, bytes on macOS)"
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+
+def run_one(name: str, params: dict, repeats: int) -> dict:
+    "run a benchmark in this process"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        kwargs = dict(params, tmpdir=tmpdir) if name in ("fcgr_kmc","fcgr_samples") else params
+        run, n_bases = BENCHMARKS[name](**kwargs)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    seconds = min(times)
+    return dict(name=name, params=params, seconds=seconds,
+                bases_per_second=n_bases / seconds if n_bases else None, peak_rss_mb=peak_rss_mb())
+
+def run_subprocess(name: str, params: dict, repeats: int) -> dict:
+    "run a benchmark in a new process, to measure its own peak memory"
+    cmd = [sys.executable, __file__, "--run", json.dumps([name, params]), "--repeats", str(repeats)]
+    out = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def startup(repeats: int = 5) -> dict:
+    "seconds to start python and 'import complexcgr' (median), and without importing it"
+    def median_time(code):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], check=True)
+            times.append(time.perf_counter() - start)
+        return statistics.median(times)
+    python = median_time("pass")
+    total = median_time("import complexcgr")
+    return dict(python_seconds=python, import_seconds=total - python)
+
+def metadata(quick: bool) -> dict:
+    import complexcgr
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        commit = None
+    return dict(version=complexcgr.__version__, commit=commit, quick=quick, python=platform.python_version(),
+                numpy=np.__version__, platform=platform.platform(), cpu_count=os.cpu_count(),
+                date=time.strftime("%Y-%m-%d %H:%M:%S"))
+
+def key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True)
+
+def compare(results: list, path_reference: str):
+    "print the change in throughput with respect to previous results"
+    with open(path_reference) as fp:
+        reference = {key(r): r for r in json.load(fp)["results"]}
+    for result in results:
+        old = reference.get(key(result))
+        if old is None:
+            continue
+        ratio = old["seconds"] / result["seconds"]
+        flag = "  <-- slower" if ratio < 0.9 else ""
+        print(f"{result['name']:14} {json.dumps(result['params']):80} x{ratio:.2f}{flag}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="benchmark-results.json", help="json file with the results")
+    parser.add_argument("--quick", action="store_true", help="smaller inputs, for a quick check")
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--filter", default=None, help="run only the benchmarks with this name")
+    parser.add_argument("--compare", default=None, help="json file with previous results")
+    parser.add_argument("--run", default=None, help=argparse.SUPPRESS) # run a single benchmark, used internally
+    args = parser.parse_args()
+
+    if args.run is not None:
+        name, params = json.loads(args.run)
+        print(json.dumps(run_one(name, params, args.repeats)))
+        return
+
+    results = []
+    for name, params in suite(args.quick):
+        if args.filter is not None and name != args.filter:
+            continue
+        result = run_subprocess(name, params, args.repeats)
+        throughput = f"{result['bases_per_second']:.3g} bases/s" if result["bases_per_second"] else ""
+        print(f"{name:14} {json.dumps(params):80} {result['seconds']:.4f}s {throughput:18} {result['peak_rss_mb']:.0f} MB")
+        results.append(result)
+
+    output = dict(metadata=metadata(args.quick), startup=startup(), results=results)
+    print(f"import complexcgr: {output['startup']['import_seconds']:.3f}s")
+    with open(args.output, "w") as fp:
+        json.dump(output, fp, indent=2)
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,13 @@ from .cgr import CGR
 from .icgr import iCGR
 from .complexcgr import ComplexCGR
 
-# from k-mers
+# from k-mers (matplotlib, PIL and tqdm are imported only by the methods that use them)
 from .fcgr import FCGR
 from .fcgr_kmc import FCGRKmc
-from .complexfcgr import ComplexFCGR
\ No newline at end of file
+from .fcgr_samples import FCGRSamples
+from .complexfcgr import ComplexFCGR
+from .fcgr_scanner import FCGRScanner
+from .sparse import SparseFCGR
+from .fcgr_dataset import FCGRDataset
+from .cache import FCGRCache
+from .distances import FCGRIndex
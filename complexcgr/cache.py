@@ -0,0 +1,134 @@
+"On-disk cache of pixel maps and FCGRs, as .npy files that are read memory-mapped"
+import os
+import hashlib
+import tempfile
+import numpy as np
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+try:
+    import fcntl
+except ImportError: # not available on Windows, evictions are not locked
+    fcntl = None
+
+# default directory and size of the cache
+CACHE_DIR = os.environ.get("COMPLEXCGR_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "complexcgr"))
+CACHE_SIZE = 2**30
+
+def hash_bytes(data) -> str:
+    "Content hash of a sequence (str, bytes or a contiguous array)"
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+def hash_file(path, block_size: int = 2**20) -> str:
+    "Content hash of a file"
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class FCGRCache:
+    """
+    Arrays stored in a directory as <key>.npy, evicted in LRU order when their size is above max_bytes.
+
+    Files are written to a temporary file and moved to their name with os.replace, so several processes
+    can read and write the same cache: a file is either complete or not there. Hits update the modification
+    time of the file, which is the order used for the evictions (under an exclusive lock on the directory).
+    Arrays are returned memory-mapped and read-only.
+
+    >>> cache = FCGRCache("path/to/cache", max_bytes=2**30)
+    >>> fcgr = FCGR(k=8, cache=cache)
+    >>> fcgr(seq) # computed and saved in the cache
+    >>> fcgr(seq) # read from the cache
+    """
+    def __init__(self, directory: Union[str, Path, None] = None, max_bytes: int = CACHE_SIZE):
+        self.directory = Path(CACHE_DIR if directory is None else directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(*parts) -> str:
+        "Key for a tuple of (hashable, with a stable repr) parts, e.g. class name, k, and the hash of the input"
+        return hashlib.blake2b(repr(parts).encode(), digest_size=20).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory.joinpath(f"{key}.npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        "Array saved with key, None if it is not in the cache"
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, ValueError): # not in the cache, or evicted meanwhile
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return array
+
+    def put(self, key: str, array: np.ndarray) -> np.ndarray:
+        "Save an array with key, returns it memory-mapped from the cache"
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-", suffix=".npy")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                np.save(fp, np.asarray(array))
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        self.evict()
+        cached = self.get(key)
+        return np.asarray(array) if cached is None else cached
+
+    def get_or_compute(self, key: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        "Array saved with key, computed (and saved) if it is not in the cache"
+        array = self.get(key)
+        if array is None:
+            array = self.put(key, compute())
+        return array
+
+    def entries(self,):
+        "(path, size, last use) of the arrays in the cache"
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy") and not entry.name.startswith(".tmp-"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def size(self,) -> int:
+        "Size (in bytes) of the arrays in the cache"
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self,):
+        "Remove the least recently used arrays until the cache fits in max_bytes"
+        with open(self.directory.joinpath(".lock"), "wb") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = sorted(self.entries(), key=lambda entry: entry[2])
+            total = sum(size for _, size, _ in entries)
+            for path, size, _ in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self,):
+        for path, _, _ in self.entries():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def __repr__(self,):
+        return f"FCGRCache(directory={str(self.directory)!r}, max_bytes={self.max_bytes})"
@@ -1,6 +1,8 @@
 "From original work: CGR for gene structure"
 from typing import Dict, Optional 
 from collections import namedtuple
+import numpy as np
+from .kmers import kmers2array, pack_digits, unpack_digits
 
 # coordinates for x+iy
 Coord = namedtuple("Coord", ["x","y"])
@@ -11,11 +13,26 @@ CGRCoords = namedtuple("CGRCoords", ["N","x","y"])
 # coordinates for each nucleotide in the 2d-plane
 DEFAULT_COORDS = dict(A=Coord(1,1),C=Coord(-1,1),G=Coord(-1,-1),T=Coord(1,-1))
 
+# nucleotides processed at once in the scan of the trajectory: 
+# partial sums of c_i*2**i are exact in float64 up to 2**52 
+SCAN_BLOCK = 52
+
 class CGR: 
     "Chaos Game Representation for DNA"
     def __init__(self, coords: Optional[Dict[chr,tuple]]=None):
         self.nucleotide_coords = DEFAULT_COORDS if coords is None else coords
         self.cgr_coords = CGRCoords(0,0,0)
+
+        # bit-planes: each nucleotide sets a bit in x (and y) if its coordinate is +1 (and not if it is -1)
+        # only possible if the coordinates of the nucleotides are the 4 corners (+-1,+-1)
+        self.use_bitplanes = sorted(map(tuple, self.nucleotide_coords.values())) == [(-1,-1),(-1,1),(1,-1),(1,1)]
+        if self.use_bitplanes:
+            self.nuc2bit = np.full((256,2), 2, dtype=np.uint8) # 2 for symbols without coordinates
+            self.bits2nuc = np.zeros((2,2), dtype=np.uint8)
+            for nucleotide, (x,y) in self.nucleotide_coords.items():
+                bx, by = int(x > 0), int(y > 0)
+                self.nuc2bit[ord(nucleotide)] = bx, by
+                self.bits2nuc[bx, by] = ord(nucleotide)
     
     def nucleotide_by_coords(self,x,y):
         "Get nucleotide by coordinates (x,y)"
@@ -74,4 +91,97 @@ class CGR:
         while self.cgr_coords.N>0: 
             nucleotide = self.backward()
             sequence.append(nucleotide)
-        return "".join(sequence[::-1])      
\ No newline at end of file
+        return "".join(sequence[::-1])
+
+    def encode_many(self, kmers):
+        """CGR of many k-mers of the same length N <= 32 at once, as integer grid coordinates (uint64 arrays):
+        the column and row (from the bottom) of the cell of the CGR point in a 2**N x 2**N grid, that is,
+        x = (2*col+1)/2**N - 1 and y = (2*row+1)/2**N - 1. The i-th bit of col (row) is set if the x (y) coordinate 
+        of the i-th nucleotide is +1. kmers is a NumPy S-dtype array (or a list of str) or a (n,N) uint8 array"""
+        if not self.use_bitplanes:
+            raise ValueError("encode_many requires the coordinates of the nucleotides to be (+-1,+-1)")
+        kmers = kmers2array(kmers)
+        bx, by = self.nuc2bit[:,0][kmers], self.nuc2bit[:,1][kmers]
+        if (bx == 2).any():
+            raise ValueError(f"k-mers must contain only {list(self.nucleotide_coords)}")
+        N = kmers.shape[1]
+        if N > 32:
+            raise ValueError("encode_many supports k-mers up to length 32")
+        return pack_digits(bx, 1), pack_digits(by, 1)
+
+    def decode_many(self, cols: np.ndarray, rows: np.ndarray, N: int) -> np.ndarray:
+        "k-mers (S-dtype array) from their CGR grid coordinates (see encode_many), all of length N"
+        if not self.use_bitplanes:
+            raise ValueError("decode_many requires the coordinates of the nucleotides to be (+-1,+-1)")
+        return self.bits2nuc[unpack_digits(cols, 1, N), unpack_digits(rows, 1, N)].view(f"S{N}").ravel()
+
+    def trajectory(self, sequence: str, invalid: str = "skip") -> np.ndarray:
+        """All the points of the CGR of a sequence, as an (n,2) array, one point for each nucleotide.
+        Symbols without coordinates (N, ...) do not have a point, and
+        - invalid="skip": are ignored, as if they were not in the sequence
+        - invalid="reset": the trajectory starts again from (0,0) after them
+        """
+        if invalid not in ("skip","reset"):
+            raise ValueError("invalid must be 'skip' or 'reset'")
+        if isinstance(sequence, str):
+            sequence = sequence.encode("ascii", errors="replace")
+        symbols = np.frombuffer(sequence, dtype=np.uint8)
+
+        # coordinates of each nucleotide, nan for the other symbols
+        table = np.full((256,2), np.nan)
+        for nucleotide, (x,y) in self.nucleotide_coords.items():
+            table[ord(nucleotide)] = x, y
+        coords = table[symbols]
+        valid = ~np.isnan(coords[:,0])
+
+        # a nucleotide starts from (0,0) if it is the first one, or if it follows an invalid symbol
+        reset = np.zeros(len(symbols), dtype=bool)
+        if invalid == "reset":
+            reset[1:] = ~valid[:-1]
+        reset[0:1] = True
+        coords, reset = coords[valid], reset[valid]
+        return np.stack([self._scan(coords[:,axis], reset) for axis in (0,1)], axis=1)
+
+    @staticmethod
+    def _scan(c: np.ndarray, reset: np.ndarray, block: int = SCAN_BLOCK) -> np.ndarray:
+        """Solve x_{i+1} = (x_i + c_i)/2 for all i, with x = 0 before the positions in reset.
+        In a block starting from x_start, after j+1 steps x = (x_start + sum_{m<=j} c_m*2**m) / 2**(j+1), 
+        with exact partial sums. The start of a block is the end of the previous one: the end of the block 
+        before it is weighted by 2**-block, and older ones are below float64 precision"""
+        n = len(c)
+        n_blocks = -(-n // block)
+        C = np.zeros(n_blocks*block)
+        C[:n] = c
+        R = np.zeros(n_blocks*block, dtype=bool)
+        R[:n] = reset
+        C, R = C.reshape(n_blocks, block), R.reshape(n_blocks, block)
+
+        terms = C * 2.0**np.arange(block)
+        S = np.cumsum(terms, axis=1)
+        S_before = S - terms # partial sums before each position
+
+        # last reset in the block up to each position
+        last_reset = np.maximum.accumulate(np.where(R, np.arange(block), -1), axis=1)
+        after_reset = last_reset >= 0
+        base = -np.take_along_axis(S_before, np.maximum(last_reset, 0), axis=1)
+
+        # end of each block starting from 0 (or from its last reset), then the start of each block
+        scale = 2.0**-block
+        end = (S[:,-1] + np.where(after_reset[:,-1], base[:,-1], 0)) * scale
+        start = np.zeros(n_blocks)
+        start[1:] = end[:-1]
+        start[2:] += np.where(after_reset[1:-1,-1], 0, end[:-2] * scale)
+
+        x = (np.where(after_reset, base, start[:,None]) + S) * 2.0**-np.arange(1, block+1)
+        return x.ravel()[:n]
+
+    def density(self, points, resolution: int) -> np.ndarray:
+        """Number of points of the CGR (from trajectory, or a sequence) in each cell of a resolution x resolution grid, 
+        with the same orientation than FCGR: for resolution 2**k and points after the first k-1 nucleotides, it is the FCGR of k-mers"""
+        if isinstance(points, (str, bytes)):
+            points = self.trajectory(points)
+        points = np.asarray(points, dtype=np.float64)
+        # cell of each point, the row 0 is the top of the plane (y=1)
+        cols = np.clip(((points[:,0] + 1) / 2 * resolution).astype(np.int64), 0, resolution-1)
+        rows = resolution - 1 - np.clip(((points[:,1] + 1) / 2 * resolution).astype(np.int64), 0, resolution-1)
+        return np.bincount(rows*resolution + cols, minlength=resolution**2).reshape(resolution, resolution)
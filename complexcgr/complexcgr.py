@@ -1,5 +1,7 @@
 from typing import Dict, List
 from collections import namedtuple
+import numpy as np
+from .kmers import kmers2array, pack_digits, unpack_digits
 
 # coordinates for x+iy
 Coord = namedtuple("Coord", ["x","y"])
@@ -12,13 +14,19 @@ class ComplexCGR:
     def __init__(self, nucleotide_order: List[str] = ["A","C","G","T"]):
         self.nucleotide_order = nucleotide_order
         self.cgr_coords = CGRCoords(0,0) # complexCGR coordinates 
+
+        # digit (id) of each nucleotide, 4 for any other symbol
+        self.nuc2id = np.full(256, 4, dtype=np.uint8)
+        for idx, nucleotide in enumerate(nucleotide_order):
+            self.nuc2id[ord(nucleotide)] = idx
+        self.id2nuc = np.frombuffer("".join(nucleotide_order).encode(), dtype=np.uint8)
     
     def id(self, nucleotide): 
         return self.nucleotide_order.index(nucleotide)
             
     def forward(self, nucleotide: str): 
         "compute next complexCGR coordinates"
-        k = self.id(nucleotide)*4**(self.cgr_coords.N) + self.cgr_coords.k
+        k = self.id(nucleotide) << 2*self.cgr_coords.N | self.cgr_coords.k
 
         # update cgr_coords
         self.cgr_coords = CGRCoords(k,self.cgr_coords.N+1)
@@ -28,7 +36,7 @@ class ComplexCGR:
         nucleotide = self.current_nucleotide()    
 
         # compute previous k
-        k = self.cgr_coords.k - self.id(nucleotide)*4**(self.cgr_coords.N-1)
+        k = self.cgr_coords.k - (self.id(nucleotide) << 2*(self.cgr_coords.N-1))
 
         # update cgr_coords
         self.cgr_coords = CGRCoords(k,self.cgr_coords.N-1)
@@ -36,14 +44,53 @@ class ComplexCGR:
         return nucleotide
     
     def encode(self, sequence: str): 
-        "From DNA to complexCGR"
+        """From DNA to complexCGR.
+        k = sum id(nucleotide_i)*4**i is a number in base 4 with the first nucleotide as the least significant digit,
+        so the ids are packed 4 per byte (little endian) and converted to an integer at once"""
+        ids = self.nuc2id[np.frombuffer(sequence.encode("ascii", errors="replace"), dtype=np.uint8)]
+        if (ids == 4).any():
+            raise ValueError(f"sequence must contain only {self.nucleotide_order}")
+        N = len(ids)
+        digits = np.zeros(-(-N // 4) * 4, dtype=np.uint8)
+        digits[:N] = ids
+        digits = digits.reshape(-1,4) << np.array([0,2,4,6], dtype=np.uint8)
+        packed = np.bitwise_or.reduce(digits, axis=1)
+        self.cgr_coords = CGRCoords(int.from_bytes(packed.tobytes(), "little"), N)
+        return self.cgr_coords
+
+    def decode(self, k: int, N: int): 
+        "From complexCGR to DNA, unpacking the base 4 digits of k (see encode)"
+        k, N = int(k), int(N) # NumPy integers (e.g. from encode_many) have no bit_length/to_bytes
+        if k < 0 or k.bit_length() > 2*N:
+            raise ValueError(f"k must be in [0, 4**N) for N={N}")
+        self.cgr_coords = CGRCoords(k,N)
+        packed = np.frombuffer(k.to_bytes(-(-N // 4), "little"), dtype=np.uint8)
+        ids = (packed[:,None] >> np.array([0,2,4,6], dtype=np.uint8)) & 3
+        return self.id2nuc[ids.ravel()[:N]].tobytes().decode()
+
+    def encode_many(self, kmers) -> np.ndarray:
+        """ComplexCGR k of many k-mers of the same length (k <= 32) at once, as uint64.
+        kmers is a NumPy S-dtype array (or a list of str) or a (n,k) uint8 array, N is the length of the k-mers"""
+        ids = self.nuc2id[kmers2array(kmers)]
+        if (ids == 4).any():
+            raise ValueError(f"k-mers must contain only {self.nucleotide_order}")
+        if ids.shape[1] > 32:
+            raise ValueError("encode_many supports k-mers up to length 32")
+        return pack_digits(ids, 2)
+
+    def decode_many(self, ks: np.ndarray, N: int) -> np.ndarray:
+        "k-mers (S-dtype array) from their ComplexCGR k (see encode_many), all of length N"
+        return self.id2nuc[unpack_digits(ks, 2, N)].view(f"S{N}").ravel()
+
+    def encode_reference(self, sequence: str):
+        "From DNA to complexCGR, one nucleotide at a time. Kept as reference"
         self.reset_coords()
         for nucleotide in sequence: 
             self.forward(nucleotide)
         return self.cgr_coords
 
-    def decode(self, k: int, N: int): 
-        "From complexCGR to DNA"
+    def decode_reference(self, k: int, N: int):
+        "From complexCGR to DNA, one nucleotide at a time. Kept as reference"
         self.cgr_coords = CGRCoords(k,N)
         
         # decoded sequence
@@ -56,17 +103,9 @@ class ComplexCGR:
         return "".join(sequence[::-1])
 
     def current_nucleotide(self,): 
-        "Get current nucleotide based on k and N"
+        "Get current nucleotide based on k and N: the most significant digit (in base 4) of k"
         k,N = self.cgr_coords.k, self.cgr_coords.N
-        alpha = k/4**N
-        if alpha <0.25: 
-            return self.nucleotide_order[0]
-        elif alpha <0.5:
-            return self.nucleotide_order[1]
-        elif alpha < 0.75:
-            return self.nucleotide_order[2]
-        else:
-            return self.nucleotide_order[3]
+        return self.nucleotide_order[(k >> 2*(N-1)) & 3]
 
     def reset_coords(self,):
         self.cgr_coords = CGRCoords(0,0)
@@ -1,11 +1,38 @@
 from . import ComplexCGR
-import matplotlib.pyplot as plt
+from .kmers import count_kmers, reverse_codes, sliding_min
+from .instrumentation import stage
 from itertools import product
-from collections import defaultdict
-from tqdm import tqdm
-from PIL import Image
+from functools import lru_cache
 import numpy as np 
 
+# images rendered at once in ComplexFCGR.render_many, bounds the memory used
+RENDER_CHUNK = 64
+
+@lru_cache(maxsize=None)
+def complex_index(k: int) -> np.ndarray:
+    """ComplexCGR k of each k-mer, indexed by its 2-bit code (first nucleotide the most significant).
+    k = sum id_i*4**i has the first nucleotide as the least significant digit, so it is the reversed code"""
+    index = reverse_codes(np.arange(4**k, dtype=np.int64), k)
+    index.flags.writeable = False
+    return index
+
+@lru_cache(maxsize=8)
+def polar_grid(k: int, size: int):
+    """Wedge (ComplexCGR k) and radius (in [0,1]) of each pixel of a size x size image of the ComplexFCGR.
+    The wedge of k spans the angles [2*pi*k/4**k, 2*pi*(k+1)/4**k), counterclockwise from the right, 
+    pixels outside the circle have wedge -1"""
+    center = (size - 1) / 2
+    rows, cols = np.mgrid[0:size, 0:size]
+    x, y = (cols - center) / (size / 2), (center - rows) / (size / 2)
+    radius = np.hypot(x, y)
+    angle = np.mod(np.arctan2(y, x), 2*np.pi)
+    wedge = np.minimum((angle / (2*np.pi) * 4**k).astype(np.int64), 4**k - 1)
+    wedge[radius > 1] = -1
+    wedge, radius = wedge.ravel(), radius.ravel().astype(np.float32)
+    wedge.flags.writeable = False
+    radius.flags.writeable = False
+    return wedge, radius
+
 
 class ComplexFCGR(ComplexCGR): 
     """Circular density plot based on CGR"""
@@ -14,8 +41,8 @@ class ComplexFCGR(ComplexCGR):
         super().__init__()
         self.k = k # k-mer representation
         self.kmers = product("ACGT", repeat=self.k) # all kmers of length k
-        self.freq_kmer = None # dict to save representativity of each kmer
-        self.probabilities = None # dict to save probabilities/density for each kmer
+        self.counts = None # array with the representativity of each kmer, indexed by its ComplexCGR k
+        self.probabilities = None # array with the probabilities/density for each kmer, indexed by its ComplexCGR k
         self.fig = None # to save matlotlib figure and then save as image
     
     def __call__(self, sequence: str, w=1):
@@ -24,42 +51,54 @@ class ComplexFCGR(ComplexCGR):
         self.plot(w)
     
     def count_kmers(self, sequence: str): 
-        self.freq_kmer = defaultdict(int)
-        # representativity of kmers
-        len_seq = len(sequence)
-        for j,_ in enumerate(sequence):
-            if j+self.k <= len_seq:
-                subseq = sequence[j:j+self.k]
-                if "N" not in subseq:
-                    self.freq_kmer[subseq] +=1
+        "Count k-mers (without N's) of the sequence, indexed by their ComplexCGR k"
+        counts = count_kmers(sequence, self.k)
+        with stage("pixels"):
+            self.counts = np.zeros(4**self.k, dtype=np.int64)
+            self.counts[complex_index(self.k)] = counts
+
+    @property
+    def freq_kmer(self,):
+        "dict with the representativity of each kmer found"
+        if self.counts is None:
+            return None
+        ks = np.flatnonzero(self.counts)
+        kmers = self.decode_many(ks, self.k).astype(str)
+        return dict(zip(kmers.tolist(), self.counts[ks].tolist()))
         
     def kmer_probabilities(self, sequence: str):
-        self.probabilities = defaultdict(float)
         N=len(sequence)
-        for key, value in self.freq_kmer.items():
-            self.probabilities[key] = float(value) / (N - self.k + 1)
+        self.probabilities = self.counts / (N - self.k + 1)
 
     def plot(self, w: int = 1):        
         "Given a FCGR, plot it in grayscale"
-        ax = plt.subplot(111, polar=True)
-        center, bottom, width, height = self.compute_input_plot()
-        
-        # scale width by 'w'
-        width = [w*_ for _ in width]
-        print("generating plot")
-        ax.bar(x=center, # center of the angle
-                width=width, # width of the angle
-                bottom=bottom, # lowest value
-                height=height, # highest value 
-            )
+        import matplotlib.pyplot as plt
+        with stage("render"):
+            ax = plt.subplot(111, polar=True)
+            center, bottom, width, height = self.compute_input_plot()
+            
+            # scale width by 'w'
+            width = [w*_ for _ in width]
+            ax.bar(x=center, # center of the angle
+                    width=width, # width of the angle
+                    bottom=bottom, # lowest value
+                    height=height, # highest value 
+                )
 
         ax.axes.get_xaxis().set_visible(False)
         ax.axes.get_yaxis().set_visible(False)
 
         return ax.figure
 
-    def save(self, ccgr, path: str):
-        "save complexFCGR as image"
+    def save(self, ccgr, path: str, backend: str = "matplotlib", size: int = 512, bits: int = 8):
+        """save complexFCGR as image, drawn with matplotlib or (backend='raster') with render,
+        in a size x size image with 8 or 16 bits"""
+        from PIL import Image
+        if backend == "raster":
+            # the dtype of the image gives the mode (L for uint8, I;16 for uint16)
+            Image.fromarray(self.render(size=size, bits=bits)).save(path)
+            return
+
         # get figure
         fig = self.plot() 
 
@@ -68,6 +107,7 @@ class ComplexFCGR(ComplexCGR):
         
         # save image 
         img.save(path)
+        import matplotlib.pyplot as plt
         plt.close(fig)
 
     @staticmethod
@@ -75,6 +115,7 @@ class ComplexFCGR(ComplexCGR):
         "Convert a Matplotlib figure to a PIL Image and return it"
         #https://stackoverflow.com/questions/57316491/how-to-convert-matplotlib-figure-to-pil-image-object-without-saving-image
         import io
+        from PIL import Image
         buf = io.BytesIO()
         fig.savefig(buf)
         buf.seek(0)
@@ -86,18 +127,63 @@ class ComplexFCGR(ComplexCGR):
         "Compute input for plot CFCGR"
         delta = 2*np.pi/4**self.k # angle between consecutive roots
 
-        center = []
-        width  = []
-        height = []
-        bottom = []
-
-        for kmer in tqdm(self.probabilities): 
-            h = self.probabilities.get(kmer,0.0) # height (density) of the bar in the circle
-            theta = 2*self.encode(kmer).k*np.pi/4**self.k # angle of k-esim root
-            c = theta + delta/2 # center of the angle
-            center.append(c)
-            bottom.append(0) 
-            width.append(50*delta)
-            height.append(h)
-
-        return center, bottom, width, height
\ No newline at end of file
+        # only kmers found in the sequence, angle of the k-esim root
+        ks = np.flatnonzero(self.probabilities)
+        height = self.probabilities[ks] # height (density) of the bar in the circle
+        center = 2*ks*np.pi/4**self.k + delta/2 # center of the angle
+        bottom = np.zeros(len(ks))
+        width = np.full(len(ks), 50*delta)
+
+        return center, bottom, width, height
+
+    # # --------------- raster backend ---------------- # #
+    def render(self, probabilities: np.ndarray = None, size: int = 512, bits: int = 8, w: int = 1) -> np.ndarray:
+        """Draw the ComplexFCGR in a size x size image (uint8 or uint16 for bits=16) without matplotlib.
+        Each kmer is a bar with radius proportional to its probability (indexed by ComplexCGR k, 
+        by default the ones of the last sequence), scaled to the maximum one. As in plot, bars are 50*w
+        roots wide, where they overlap the highest one is drawn. 
+        Bars are filled from white (low) to black (high), the background is white"""
+        probabilities = self.probabilities if probabilities is None else probabilities
+        return self.render_many(np.asarray(probabilities)[None], size, bits, w)[0]
+
+    def render_many(self, probabilities: np.ndarray, size: int = 512, bits: int = 8, w: int = 1) -> np.ndarray:
+        "Draw many ComplexFCGRs (rows of probabilities, indexed by ComplexCGR k) at once, see render"
+        if bits not in (8, 16):
+            raise ValueError("bits must be 8 or 16")
+        dtype = np.uint8 if bits == 8 else np.uint16
+        max_color = 2**bits - 1
+        wedge, radius = polar_grid(self.k, size)
+        inside = wedge >= 0
+
+        probabilities = np.asarray(probabilities, dtype=np.float64)
+        images = np.full((len(probabilities), size*size), max_color, dtype=dtype)
+        with stage("render"):
+            for start in range(0, len(probabilities), RENDER_CHUNK):
+                chunk = probabilities[start:start+RENDER_CHUNK]
+                scale = chunk.max(axis=1, keepdims=True)
+                heights = np.divide(chunk, scale, out=np.zeros_like(chunk), where=scale > 0).astype(np.float32)
+                heights = np.stack([self.widen(h, int(50*w)) for h in heights])
+                # height of the wedge of each pixel, the pixel is drawn if it is below it
+                pixel_heights = heights[:, wedge[inside]]
+                drawn = (radius[inside] <= pixel_heights) & (pixel_heights > 0)
+                colors = np.round(max_color * (1 - pixel_heights)).astype(dtype)
+                images[start:start+len(chunk), inside] = np.where(drawn, colors, max_color)
+        return images.reshape(-1, size, size)
+
+    @staticmethod
+    def widen(heights: np.ndarray, width: int) -> np.ndarray:
+        "Highest bar covering each root, for bars width roots wide centered in their root (circular sliding max)"
+        if width <= 1:
+            return heights
+        left, right = width // 2, width - 1 - width // 2
+        extended = np.concatenate((heights[len(heights)-left:], heights, heights[:right]))
+        return -sliding_min(-extended, width)
+
+    def render_sequences(self, sequences, size: int = 512, bits: int = 8, w: int = 1) -> np.ndarray:
+        "Images (see render) of a list of sequences, as an (n,size,size) array"
+        probabilities = np.zeros((len(sequences), 4**self.k))
+        for j, sequence in enumerate(sequences):
+            self.count_kmers(sequence)
+            self.kmer_probabilities(sequence)
+            probabilities[j] = self.probabilities
+        return self.render_many(probabilities, size, bits, w)
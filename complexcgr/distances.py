@@ -0,0 +1,205 @@
+"Distances between FCGRs, and nearest neighbours in large collections of FCGRs"
+import numpy as np
+from typing import Optional, Tuple
+from .sparse import SparseFCGR
+from .fcgr_dataset import FCGRDataset
+
+METRICS = ("euclidean","cosine","jensenshannon")
+
+# size (in bytes) of the blocks of FCGRs (as frequencies) compared at once
+BLOCK_BYTES = 2**26
+
+def as_stack(fcgrs):
+    """FCGRs as an (n, ...) array: arrays and memory-mapped arrays are used as they are (not copied),
+    a FCGRDataset by its data, a list of FCGRs (dense or SparseFCGR) is stacked"""
+    if isinstance(fcgrs, FCGRDataset):
+        return fcgrs.data
+    if isinstance(fcgrs, (list, tuple)):
+        return np.stack([fcgr.todense() if isinstance(fcgr, SparseFCGR) else np.asarray(fcgr) for fcgr in fcgrs])
+    return fcgrs
+
+def frequencies(fcgrs, dtype = "float32") -> np.ndarray:
+    "(n, cells) array with the frequencies of each FCGR of a stack (each one divided by its sum, empty FCGRs are zeros)"
+    fcgrs = np.asarray(fcgrs)
+    matrix = fcgrs.reshape(len(fcgrs), -1).astype(dtype)
+    sums = matrix.sum(axis=1, keepdims=True, dtype=np.float64)
+    return np.divide(matrix, sums, out=np.zeros_like(matrix), where=sums > 0)
+
+def pool(fcgrs, k: int) -> np.ndarray:
+    """Stack of (2**K x 2**K) FCGRs to (2**k x 2**k) by repeated 2x2 sum-pooling, which is (up to the k-mers
+    at the start of the sequences) the FCGR for k, see FCGR.pyramid"""
+    fcgrs = np.asarray(fcgrs)
+    size = fcgrs.shape[-1]
+    if fcgrs.ndim != 3 or fcgrs.shape[1] != size or size & (size-1) or 2**k > size:
+        raise ValueError(f"pooling to k={k} needs a stack of (2**K x 2**K) FCGRs with K >= k")
+    pooled = fcgrs.astype(np.float64)
+    while size > 2**k:
+        size //= 2
+        pooled = pooled.reshape(-1, size, 2, size, 2).sum(axis=(2,4))
+    return pooled
+
+def _distances(queries: np.ndarray, references: np.ndarray, metric: str) -> np.ndarray:
+    "(n_queries, n_references) distances between two matrices of frequencies"
+    if metric == "jensenshannon":
+        return _jensenshannon(queries, references)
+    # the dot products, the expensive part, are a single matmul
+    dots = queries @ references.T
+    sq_queries = np.einsum("ij,ij->i", queries, queries)
+    sq_references = np.einsum("ij,ij->i", references, references)
+    if metric == "euclidean":
+        sq_distances = sq_queries[:,None] + sq_references[None,:] - 2*dots
+        return np.sqrt(np.maximum(sq_distances, 0))
+    norms = np.sqrt(sq_queries[:,None] * sq_references[None,:])
+    similarity = np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+    return np.clip(1 - similarity, 0, 2)
+
+def _xlogx(x: np.ndarray) -> np.ndarray:
+    "x*log(x), 0 for x = 0"
+    return x * np.log(np.where(x > 0, x, 1))
+
+def _jensenshannon(queries: np.ndarray, references: np.ndarray) -> np.ndarray:
+    """Jensen-Shannon distance (square root of the divergence, base 2, in [0,1]).
+    2*divergence = sum p*log(p) + sum r*log(r) - sum (p+r)*log(p+r) + log(2)*(sum p + sum r), where 
+    the three sums with logs can be restricted to the support of the query p (elsewhere they cancel out).
+    Only the third one needs the pair of FCGRs, the others are computed once for each FCGR
+    (with a matmul for the references, over the support of each query)"""
+    supports = (queries > 0).astype(np.float64)
+    references = references.astype(np.float64)
+    reference_xlogx = _xlogx(references)
+    reference_terms = reference_xlogx @ supports.T
+    reference_entropies = reference_xlogx.sum(axis=1)
+    reference_totals = references.sum(axis=1)
+    distances = np.empty((len(queries), len(references)), dtype=queries.dtype)
+    for i, query in enumerate(queries.astype(np.float64)):
+        support = np.flatnonzero(query)
+        if len(support) < len(query) // 4:
+            # sparse query: only the cells of its support are read
+            columns, terms = support, reference_terms[:,i]
+        else:
+            # a gather costs more than the cells outside the support
+            columns, terms = slice(None), reference_entropies
+        mixture = references[:, columns] + query[columns]
+        cross = np.einsum("ij,ij->i", mixture, np.log(np.where(mixture > 0, mixture, 1)))
+        divergence = _xlogx(query[support]).sum() + terms - cross + np.log(2) * (query.sum() + reference_totals)
+        distances[i] = np.sqrt(np.maximum(divergence / 2, 0) / np.log(2))
+    return distances
+
+def _block_rows(n_cells: int, dtype) -> int:
+    "FCGRs in a block of BLOCK_BYTES"
+    return max(1, BLOCK_BYTES // (n_cells * np.dtype(dtype).itemsize))
+
+def pairwise_distances(queries, references, metric: str = "euclidean", dtype = "float32") -> np.ndarray:
+    """(n_queries, n_references) distances between the frequencies of two collections of FCGRs
+    (stacks, memory-mapped arrays or FCGRDataset). References are read in blocks of BLOCK_BYTES"""
+    if metric not in METRICS:
+        raise ValueError(f"metric must be one of {', '.join(METRICS)}")
+    queries, references = as_stack(queries), as_stack(references)
+    queries = frequencies(queries, dtype)
+    rows = _block_rows(queries.shape[1], dtype)
+    distances = np.empty((len(queries), len(references)), dtype=dtype)
+    for start in range(0, len(references), rows):
+        block = frequencies(references[start:start+rows], dtype)
+        distances[:, start:start+len(block)] = _distances(queries, block, metric)
+    return distances
+
+def _merge_nearest(indices, distances, block_indices, block_distances, n_neighbors):
+    "keep the n_neighbors smallest distances (unsorted) of each row among the current ones and a new block"
+    indices = np.concatenate((indices, block_indices), axis=1)
+    distances = np.concatenate((distances, block_distances), axis=1)
+    if distances.shape[1] > n_neighbors:
+        keep = np.argpartition(distances, n_neighbors-1, axis=1)[:, :n_neighbors]
+        indices = np.take_along_axis(indices, keep, axis=1)
+        distances = np.take_along_axis(distances, keep, axis=1)
+    return indices, distances
+
+def _sort_nearest(indices, distances):
+    order = np.argsort(distances, axis=1, kind="stable")
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+class FCGRIndex:
+    """
+    Nearest neighbours of FCGRs in a reference collection (a stack, a memory-mapped array or a FCGRDataset),
+    which is not loaded in memory: FCGRs are compared as frequencies, in blocks of BLOCK_BYTES.
+    - metric: 'euclidean', 'cosine' (both computed with matrix products) or 'jensenshannon'
+    - prefilter_k: keep in memory the references pooled to (2**prefilter_k x 2**prefilter_k), see pool.
+      Queries are first compared to them, and only the closest n_candidates references are compared at full
+      resolution. It is much faster for large collections, but a true neighbour can be missed
+    - dtype: float32 (default) or float64, for the frequencies and distances
+
+    >>> index = FCGRIndex(FCGRDataset("references.fcgr"), metric="cosine", prefilter_k=4)
+    >>> indices, distances = index.nearest(fcgrs, n_neighbors=10)
+    """
+    def __init__(self, references, metric: str = "euclidean", prefilter_k: Optional[int] = None, dtype = "float32"):
+        if metric not in METRICS:
+            raise ValueError(f"metric must be one of {', '.join(METRICS)}")
+        self.references = as_stack(references)
+        self.metric = metric
+        self.dtype = np.dtype(dtype)
+        self.prefilter_k = prefilter_k
+        self.pooled = None
+        if prefilter_k is not None:
+            rows = _block_rows(int(np.prod(self.references.shape[1:])), np.float64)
+            self.pooled = np.concatenate([frequencies(pool(self.references[start:start+rows], prefilter_k), self.dtype)
+                                          for start in range(0, len(self.references), rows)])
+
+    def __len__(self,):
+        return len(self.references)
+
+    def _queries(self, queries):
+        "stack of queries, a single FCGR is a stack of one"
+        queries = as_stack(queries)
+        if np.shape(queries) == self.references.shape[1:]:
+            queries = np.asarray(queries)[None]
+        return queries
+
+    def distances(self, queries) -> np.ndarray:
+        "(n_queries, n_references) distances of the queries to all the references"
+        return pairwise_distances(self._queries(queries), self.references, self.metric, self.dtype)
+
+    def nearest(self, queries, n_neighbors: int = 10, n_candidates: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Indices and distances (n_queries, n_neighbors) of the closest references to each query, from the closest.
+        - n_candidates: with prefilter_k, references compared at full resolution for each query (10*n_neighbors by default)"""
+        queries = self._queries(queries)
+        n_neighbors = min(n_neighbors, len(self))
+        if self.pooled is None:
+            return self._nearest_scan(queries, n_neighbors)
+        n_candidates = max(n_candidates or 10*n_neighbors, n_neighbors)
+        return self._nearest_prefilter(queries, n_neighbors, n_candidates)
+
+    def _nearest_scan(self, queries, n_neighbors):
+        "compare the queries with all the references, one block at a time"
+        queries = frequencies(queries, self.dtype)
+        indices = np.zeros((len(queries), 0), dtype=np.int64)
+        distances = np.zeros((len(queries), 0), dtype=self.dtype)
+        rows = _block_rows(queries.shape[1], self.dtype)
+        for start in range(0, len(self), rows):
+            block = frequencies(self.references[start:start+rows], self.dtype)
+            block_indices = np.broadcast_to(np.arange(start, start+len(block)), (len(queries), len(block)))
+            indices, distances = _merge_nearest(indices, distances, block_indices,
+                                                _distances(queries, block, self.metric), n_neighbors)
+        return _sort_nearest(indices, distances)
+
+    def _nearest_prefilter(self, queries, n_neighbors, n_candidates):
+        "candidates by the distance between pooled FCGRs, then the closest ones at full resolution"
+        pooled = frequencies(pool(queries, self.prefilter_k), self.dtype)
+        candidates = np.zeros((len(queries), 0), dtype=np.int64)
+        candidate_distances = np.zeros((len(queries), 0), dtype=self.dtype)
+        rows = _block_rows(pooled.shape[1], self.dtype)
+        for start in range(0, len(self), rows):
+            block = self.pooled[start:start+rows]
+            block_indices = np.broadcast_to(np.arange(start, start+len(block)), (len(queries), len(block)))
+            candidates, candidate_distances = _merge_nearest(candidates, candidate_distances, block_indices,
+                                                             _distances(pooled, block, self.metric), n_candidates)
+
+        queries = frequencies(queries, self.dtype)
+        indices = np.empty((len(queries), n_neighbors), dtype=np.int64)
+        distances = np.empty((len(queries), n_neighbors), dtype=self.dtype)
+        for i, rows in enumerate(np.sort(candidates, axis=1)):
+            # only the candidates are read from the references
+            row_distances = _distances(queries[i:i+1], frequencies(self.references[rows], self.dtype), self.metric)[0]
+            nearest = np.argsort(row_distances, kind="stable")[:n_neighbors]
+            indices[i], distances[i] = rows[nearest], row_distances[nearest]
+        return indices, distances
+
+    def __repr__(self,):
+        return f"FCGRIndex(n={len(self)}, metric={self.metric!r}, prefilter_k={self.prefilter_k}, dtype={self.dtype})"
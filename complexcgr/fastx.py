@@ -0,0 +1,283 @@
+"Chunked reader for FASTA/FASTQ files (plain or gzipped) without per-read objects"
+import os
+import gzip
+import itertools
+import queue
+import threading
+from collections import namedtuple
+import numpy as np
+
+# Reads of a block of the file, concatenated in one uint8 array (seq) where each read ends with a newline.
+# The newline is not a nucleotide, so no k-mer is counted across two reads.
+# For FASTQ files, qual is aligned position by position with seq (phred+33), for FASTA files it is None.
+# n_bytes is the number of bytes of the (uncompressed) file consumed by the batch.
+ReadBatch = namedtuple("ReadBatch", ["seq","qual","n_reads","n_bytes"])
+
+# Records of a block of a FASTA file, for FCGR.from_fasta. seq is as in ReadBatch, ids are the ids of the records
+# that start in the batch and starts the position in seq of their first nucleotide (right after their newline).
+FastaBatch = namedtuple("FastaBatch", ["seq","ids","starts","n_reads","n_bytes"])
+
+# size of the blocks read from the file
+BLOCK_SIZE = 2**22
+
+NEWLINE, CARRIAGE_RETURN = ord("\n"), ord("\r")
+FASTA_HEADER, FASTQ_HEADER = ord(">"), ord("@")
+
+def is_gzipped(path) -> bool:
+    "True if the file is gzipped, from its magic bytes (not its extension)"
+    with open(str(path), "rb") as fp:
+        return fp.read(2) == b"\x1f\x8b"
+
+def open_binary(path):
+    "Open a file in binary mode, decompressing it if it is gzipped"
+    if is_gzipped(path):
+        return gzip.open(str(path), "rb")
+    return open(str(path), "rb")
+
+def iter_blocks(path, block_size: int = None, prefetch: int = 4):
+    """Iterate over blocks of bytes of a file (decompressed if it is gzipped).
+    Blocks are read (and decompressed) in a background thread, up to prefetch blocks ahead"""
+    block_size = block_size or BLOCK_SIZE
+    blocks = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def read():
+        try:
+            with open_binary(path) as fp:
+                while not stop.is_set():
+                    block = fp.read(block_size)
+                    blocks.put(block)
+                    if not block:
+                        return
+        except BaseException as error:
+            blocks.put(error)
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, BaseException):
+                raise block
+            if not block:
+                return
+            yield block
+    finally:
+        # unblock the thread if the iteration ends early
+        stop.set()
+        while thread.is_alive():
+            try:
+                blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+def _line_mask(size, starts, ends):
+    "Boolean mask of length size, True in the (disjoint) ranges [start,end)"
+    marks = np.zeros(size+1, dtype=np.int8)
+    marks[starts] += 1
+    marks[ends] -= 1
+    return np.cumsum(marks[:-1], dtype=np.int8) > 0
+
+def parse_fastq(buffer: np.ndarray):
+    """Parse the complete records of a FASTQ block.
+    Returns the ReadBatch and the number of bytes consumed"""
+    newlines = np.flatnonzero(buffer == NEWLINE)
+    n_reads = len(newlines) // 4
+    if n_reads == 0:
+        return ReadBatch(np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint8), 0, 0), 0
+
+    newlines = newlines[:4*n_reads]
+    starts = np.concatenate(([0], newlines[:-1]+1))
+    if (buffer[starts[0::4]] != FASTQ_HEADER).any():
+        raise ValueError("malformed FASTQ: each record must have 4 lines and start with '@'")
+
+    # sequence and quality lines, including their newline
+    seq_starts, seq_ends = starts[1::4], newlines[1::4]+1
+    qual_starts, qual_ends = starts[3::4], newlines[3::4]+1
+    if ((seq_ends - seq_starts) != (qual_ends - qual_starts)).any():
+        raise ValueError("malformed FASTQ: sequence and quality lines of a read must have the same length")
+
+    size = newlines[-1]+1
+    seq = buffer[:size][_line_mask(size, seq_starts, seq_ends)]
+    qual = buffer[:size][_line_mask(size, qual_starts, qual_ends)]
+    return ReadBatch(seq, qual, n_reads, int(size)), int(size)
+
+def _split_fasta(buffer: np.ndarray):
+    """Join the lines of the records of a FASTA block, each header is replaced by a newline.
+    Returns the sequence, the number of bytes consumed and the start and end (the newline) of each header"""
+    newlines = np.flatnonzero(buffer == NEWLINE)
+    last_start = newlines[-1]+1 if len(newlines) > 0 else 0
+    size = len(buffer) if last_start < len(buffer) and buffer[last_start] != FASTA_HEADER else last_start
+    if size == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return np.zeros(0, dtype=np.uint8), 0, empty, empty
+
+    buffer = buffer[:size]
+    starts = np.concatenate(([0], newlines+1))
+    starts = starts[starts < size]
+    header_starts = starts[buffer[starts] == FASTA_HEADER]
+    header_ends = newlines[np.searchsorted(newlines, header_starts)]
+    in_header = _line_mask(size, header_starts, header_ends)
+
+    keep = ~in_header & (buffer != NEWLINE) & (buffer != CARRIAGE_RETURN)
+    keep[header_ends] = True # separator between records
+    return buffer[keep], int(size), header_starts, header_ends
+
+def parse_fasta(buffer: np.ndarray):
+    """Parse a FASTA block. Lines of a record are joined, and each header is replaced by a newline.
+    An incomplete sequence line at the end of the block is consumed (the record continues in the
+    next batch), an incomplete header is not.
+    Returns the ReadBatch and the number of bytes consumed"""
+    seq, size, header_starts, _ = _split_fasta(buffer)
+    return ReadBatch(seq, None, len(header_starts), size), size
+
+class FastxReader:
+    """Iterate over batches of reads (ReadBatch) of a FASTA or FASTQ file, plain or gzipped.
+    The format is inferred from the first character of the file ('>' FASTA, '@' FASTQ).
+    Blocks of the file are split in records with vectorized operations,
+    the incomplete record at the end of a block is carried to the next one.
+    - overlap: a FASTA record can continue in the next batch, so the last overlap symbols 
+      of a batch are repeated at the start of the next one (use k-1 to count k-mers)
+    - start, end: read only the bytes [start,end) of a plain file, they must be record boundaries 
+      (see fastq_split_points)
+    """
+    def __init__(self, path, block_size: int = BLOCK_SIZE, overlap: int = 0, start: int = 0, end: int = None):
+        self.path = path
+        self.block_size = block_size
+        self.overlap = overlap
+        self.start = start
+        self.end = end
+
+    def __iter__(self):
+        with open_binary(self.path) as fp:
+            if self.start > 0:
+                fp.seek(self.start)
+            remaining = float("inf") if self.end is None else self.end - self.start
+            pending = b""
+            parse = None
+            carry = np.zeros(0, dtype=np.uint8)
+            while True:
+                block = fp.read(int(min(self.block_size, remaining)))
+                remaining -= len(block)
+                eof = len(block) == 0
+                data = pending + block
+                if eof and data and not data.endswith(b"\n"):
+                    data += b"\n"
+                if parse is None and data.strip():
+                    parse = self._parser(data)
+                if parse is None:
+                    if eof:
+                        return
+                    continue
+
+                batch, consumed = parse(np.frombuffer(data, dtype=np.uint8))
+                pending = data[consumed:]
+                if batch.n_bytes > 0:
+                    if parse is parse_fasta and self.overlap > 0:
+                        batch = batch._replace(seq=np.concatenate((carry, batch.seq)))
+                        carry = batch.seq[-self.overlap:]
+                    yield batch
+                if eof:
+                    if pending.strip():
+                        raise ValueError(f"incomplete record at the end of {self.path}")
+                    return
+
+    @staticmethod
+    def _parser(data: bytes):
+        first = data.lstrip()[:1]
+        if first == b">":
+            return parse_fasta
+        if first == b"@":
+            return parse_fastq
+        raise ValueError("unknown format: the file must be a FASTA ('>') or FASTQ ('@') file")
+
+def _record_id(header: np.ndarray) -> str:
+    "id of a record: the first word of its header (without '>'), as in Bio.SeqIO"
+    words = bytes(header).decode(errors="replace").split(maxsplit=1)
+    return words[0] if words else ""
+
+def _fasta_blocks(path, block_size: int):
+    """Blocks of a file as uint8 arrays: views of a memory map for plain files (nothing is read
+    until it is used), decompressed in a background thread for gzipped files"""
+    if is_gzipped(path):
+        for block in iter_blocks(path, block_size):
+            yield np.frombuffer(block, dtype=np.uint8)
+        return
+    size = os.path.getsize(str(path))
+    if size == 0:
+        return
+    data = np.memmap(str(path), dtype=np.uint8, mode="r")
+    for start in range(0, size, block_size):
+        yield data[start:start+block_size]
+
+def iter_fasta(path, block_size: int = BLOCK_SIZE):
+    """Iterate over batches (FastaBatch) of the records of a FASTA file, plain (memory-mapped) or gzipped.
+    Newlines and headers are removed from blocks of block_size bytes with vectorized operations,
+    a record can continue in the next batch. Only a header cut at the end of a block is carried over"""
+    pending = np.zeros(0, dtype=np.uint8)
+    checked = False
+    for block in itertools.chain(_fasta_blocks(path, block_size), [None]):
+        if block is None:
+            data = pending
+            if len(data) == 0:
+                return
+            if data[-1] != NEWLINE:
+                data = np.append(data, np.uint8(NEWLINE))
+        else:
+            data = block if len(pending) == 0 else np.concatenate((pending, block))
+
+        if not checked:
+            first = bytes(data[:1024]).lstrip()[:1]
+            if not first and block is not None:
+                pending = data
+                continue
+            if first and first != b">":
+                raise ValueError(f"{path} is not a FASTA file, it must start with '>'")
+            checked = True
+
+        seq, consumed, header_starts, header_ends = _split_fasta(data)
+        pending = data[consumed:].copy()
+        if consumed > 0:
+            ids = [_record_id(data[start+1:end]) for start, end in zip(header_starts, header_ends)]
+            starts = np.flatnonzero(seq == NEWLINE) + 1
+            yield FastaBatch(seq, ids, starts, len(ids), consumed)
+        if block is None:
+            return
+
+def _fastq_record_start(buffer: np.ndarray):
+    """Position of the first line of buffer (not the first one, which may be incomplete) that starts a FASTQ record: 
+    it starts with '@' and the line two below starts with '+' (a quality line can also start with '@').
+    Returns None if there is no such line"""
+    starts = np.flatnonzero(buffer[:-1] == NEWLINE) + 1
+    if len(starts) < 3:
+        return None
+    is_record = (buffer[starts[:-2]] == FASTQ_HEADER) & (buffer[starts[2:]] == ord("+"))
+    if not is_record.any():
+        return None
+    return int(starts[:-2][is_record.argmax()])
+
+def fastq_split_points(path, n_parts: int):
+    """Split a plain FASTQ file in (about) n_parts ranges of bytes starting at a record, to be read 
+    in parallel by FastxReader(path, start=..., end=...). Returns the list of boundaries [0, ..., size]"""
+    size = os.path.getsize(str(path))
+    points = [0]
+    with open(str(path), "rb") as fp:
+        for j in range(1, n_parts):
+            offset = max(j*size // n_parts, points[-1])
+            window = 2**20
+            while True:
+                # start one byte before, to know if the offset is already at the start of a line
+                fp.seek(max(offset-1, 0))
+                buffer = np.frombuffer(fp.read(window), dtype=np.uint8)
+                position = _fastq_record_start(buffer)
+                if position is not None:
+                    points.append(max(offset-1, 0) + position)
+                    break
+                if len(buffer) < window:
+                    # no record starts after offset
+                    points.append(size)
+                    break
+                window *= 2
+    points.append(size)
+    # skip empty ranges
+    return sorted(set(points))
@@ -1,35 +1,393 @@
+import os
 from . import CGR
-from PIL import Image
-from itertools import product
+from .kmers import count_kmers, count_bits, seq2bits, canonical_codes, canonical_index, INVALID
+from .sparse import SparseFCGR
+from .fastx import iter_fasta, is_gzipped, BLOCK_SIZE
+from .instrumentation import stage, progress, timed_iter
+from .cache import hash_bytes, hash_file
+from pathlib import Path
+from itertools import product, islice
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
 import numpy as np 
 
 NUC_COMPLEMENT = {n:c for n,c in zip ("ACGT","TGCA")}
 
+# dtypes allowed for the output FCGR
+FCGR_DTYPES = ("float64","float32","uint32","uint16")
+
+# maximum number of sequences sent at once to a process in FCGR.batch
+BATCH_CHUNKSIZE = 16
+
+# FCGR used by each process in FCGR.batch
+_batch_fcgr = None
+
+def saturate(fcgr, dtype) -> np.ndarray:
+    "Cast to dtype, integer dtypes saturate at their maximum value"
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        fcgr = np.minimum(fcgr, np.iinfo(dtype).max)
+    return np.asarray(fcgr).astype(dtype, copy=False)
+
+def _init_batch_worker(fcgr):
+    global _batch_fcgr
+    _batch_fcgr = fcgr
+
+def _batch_worker(sequences, start, dtype, path):
+    "Compute the FCGRs of a chunk of sequences, written directly to the output file if provided"
+    fcgrs = saturate(np.stack([_batch_fcgr(seq) for seq in sequences]), dtype)
+    if path is None:
+        return fcgrs
+    out = np.load(str(path), mmap_mode="r+")
+    out[start:start+len(fcgrs)] = fcgrs
+    out.flush()
+
+def _as_sequence(record):
+    "sequence of a record (e.g. Bio SeqRecord), or the input if it is already a sequence"
+    if isinstance(record, (str, bytes)):
+        return record
+    return str(record.seq)
+
+@lru_cache(maxsize=None)
+def pixel_index(k: int, coords: tuple) -> np.ndarray:
+    """Flat pixel (row*2**k + col) in the FCGR matrix for each k-mer, indexed by its 2-bit code.
+    coords are the (nucleotide, Coord) items used by CGR.
+    
+    The i-th nucleotide of a k-mer moves the CGR point to one half of each axis, which 
+    sets the i-th bit of the column (x axis) and of the row (y axis, from the bottom). 
+    Then the row and column are recovered de-interleaving the 2-bit code of the k-mer, 
+    one nucleotide at a time: code = first*4**(k-1) + rest => col = col[first] | col[rest] << 1
+    """
+    coords = dict(coords)
+    col_bit = np.array([coords[n].x > 0 for n in "ACGT"], dtype=np.uint32)
+    row_bit = np.array([coords[n].y > 0 for n in "ACGT"], dtype=np.uint32)
+
+    col = np.zeros(1, dtype=np.uint32)
+    row = np.zeros(1, dtype=np.uint32)
+    for _ in range(k):
+        col = (col_bit[:,None] | (col[None,:] << np.uint32(1))).ravel()
+        row = (row_bit[:,None] | (row[None,:] << np.uint32(1))).ravel()
+    
+    # rows are counted from the top of the matrix
+    index = (np.uint32(2**k-1) - row) * np.uint32(2**k) + col
+    index.setflags(write=False)
+    return index
+
 class FCGR(CGR): 
     """Frequency matrix CGR
     an (2**k x 2**k) 2D representation will be created for a 
     n-long sequence. 
     - k represents the k-mer.
     - 2**k x 2**k = 4**k the total number of k-mers (sequences of length k)
+    - use_canonical_kmers: each k-mer is counted in the pixel of its canonical k-mer
+      (the smallest between the k-mer and its reverse complement), the other pixels are empty.
+    - canonical_layout: with canonical k-mers, 'dense' returns the (2**k x 2**k) matrix, 
+      'compact' returns a 1D array with one cell per canonical k-mer (sorted), see compact2dense.
+    - dtype: dtype of the output, one of float64, float32, uint32 or uint16. 
+      Integer dtypes saturate at their maximum value.
+    - sparse: return a SparseFCGR with the flat index and count of the non-empty pixels.
+    - cache: a FCGRCache to save (and reuse) the pixel maps and the FCGRs of the inputs already seen,
+      identified by their content. FCGRs read from the cache are read-only memory-mapped arrays.
+    - sample_fraction: approximate FCGR counting only the k-mers with a (FracMinHash) hash below this 
+      fraction of the hash space, see kmers.frac_sample. Counts are rescaled by 1/sample_fraction, so 
+      each cell is either empty or its exact count / sample_fraction: unbiased over the choice of the hash,
+      with relative error sqrt((1-s)/s) for a cell, and sqrt((1-s)/s) * sqrt(sum c_i**2) / sum c_i 
+      for the sum of cells with counts c_i (e.g. about sqrt((1-s)/(s*m)) for m cells with similar counts).
     """
 
-    def __init__(self, k: int, use_canonical_kmers: bool = False ,bits: int = 8):
+    def __init__(self, k: int, use_canonical_kmers: bool = False ,bits: int = 8, canonical_layout: str = "dense",
+                 dtype = "float64", sparse: bool = False, cache = None, sample_fraction: float = None):
         super().__init__()
         self.k = k # k-mer representation
         self.use_canonical_kmers = use_canonical_kmers
-        self.kmers = list("".join(kmer) for kmer in product("ACGT", repeat=self.k))
+        self._kmers = None # list of all k-mers, built on first access
+        self._kmer2pixel = None # dict k-mer -> pixel, built on first access
+
+        if canonical_layout not in ("dense","compact"):
+            raise ValueError("canonical_layout must be 'dense' or 'compact'")
+        self.canonical_layout = canonical_layout
 
+        if np.dtype(dtype).name not in FCGR_DTYPES:
+            raise ValueError(f"dtype must be one of {', '.join(FCGR_DTYPES)}")
+        self.dtype = np.dtype(dtype)
+        self.sparse = sparse
+
+        if sample_fraction is not None and not 0 < sample_fraction <= 1:
+            raise ValueError("sample_fraction must be in (0,1]")
+        self.sample_fraction = sample_fraction
+
+        # flat pixel (row*2**k + col) for each k-mer, indexed by its 2-bit code
+        self.cache = cache
+        coords = tuple(self.nucleotide_coords.items())
+        self.pixel_index = self._cached_table(lambda: pixel_index(self.k, coords), "pixel_index", self.k, coords)
         if use_canonical_kmers is True:
-            self.kmer2pixel = self._kmer2pixel_canonical_kmers()        
-        else:
-            self.kmer2pixel = self.kmer2pixel_position()
+            def canonical_pixel_index():
+                codes = np.arange(4**self.k, dtype=np.int64)
+                return self.pixel_index[canonical_codes(codes, self.k)]
+            self.pixel_index = self._cached_table(canonical_pixel_index, "canonical_pixel_index", self.k, coords)
+            # position of each k-mer in the compact layout
+            self.compact_index = self._cached_table(lambda: canonical_index(self.k)[0], "canonical_index", self.k)
+            self.n_canonical = int(self.compact_index.max()) + 1
     
         self.bits = bits
         self.max_color = 2**bits-1
 
+    @property
+    def kmers(self,):
+        "All the k-mers in lexicographic order, the index of a k-mer is its 2-bit code"
+        if self._kmers is None:
+            self._kmers = list("".join(kmer) for kmer in product("ACGT", repeat=self.k))
+        return self._kmers
+
+    @property
+    def kmer2pixel(self,):
+        "Pixel position (1-based) in the FCGR matrix for each k-mer"
+        if self._kmer2pixel is None:
+            pos_x, pos_y = np.divmod(self.pixel_index, 2**self.k)
+            self._kmer2pixel = dict(zip(self.kmers, zip((pos_x+1).tolist(), (pos_y+1).tolist())))
+        return self._kmer2pixel
+
     def __call__(self, sequence: str):
         "Given a DNA sequence, returns an array with his FCGR"
+        key = ("sequence", hash_bytes(sequence)) if self.cache is not None else ()
+        return self._cached(lambda: self._fcgr(sequence), *key)
+
+    def _fcgr(self, sequence):
+        counts = count_kmers(sequence, self.k, sample_fraction=self.sample_fraction)
+        with stage("pixels"):
+            return self.counts2fcgr(counts)
+
+    def from_fasta(self, path, per_record: bool = False, block_size: int = BLOCK_SIZE):
+        """Given a FASTA file (plain or gzipped), returns the FCGR of all its records (e.g. a genome),
+        or with per_record=True a generator of (record id, FCGR) for each record (e.g. each contig).
+        The file is never loaded in memory: plain files are memory-mapped and gzipped ones decompressed
+        in blocks, then newlines and headers are removed from blocks of block_size bytes. The last k-1
+        nucleotides of a block are carried to the next one, so k-mers across blocks are counted.
+        FCGRs of the records are not cached"""
+        if per_record is True:
+            return self._fasta_records(path, block_size)
+        key = ("fasta", hash_file(path)) if self.cache is not None else ()
+        return self._cached(lambda: self._fcgr_fasta(path, block_size), *key)
+
+    def _fasta_batches(self, path, block_size):
+        "batches of a FASTA file, with a progress task over its bytes"
+        # the size of the file is known in advance only if it is not compressed
+        total = os.path.getsize(path) if not is_gzipped(path) else None
+        with progress(f"Counting kmers on {Path(path).stem}", total):
+            yield from timed_iter(iter_fasta(path, block_size))
+
+    def _fcgr_fasta(self, path, block_size):
+        counts = np.zeros(4**self.k, dtype=np.int64)
+        carry = np.zeros(0, dtype=np.uint8)
+        for batch in self._fasta_batches(path, block_size):
+            # records are separated by a newline (INVALID), no k-mer is counted across them
+            bits = np.concatenate((carry, seq2bits(batch.seq)))
+            count_bits(bits, self.k, counts, self.sample_fraction)
+            carry = bits[max(len(bits)-self.k+1, 0):]
+        with stage("pixels"):
+            return self.counts2fcgr(counts)
+
+    def _fasta_records(self, path, block_size):
+        counts = np.zeros(4**self.k, dtype=np.int64)
+        carry = np.zeros(0, dtype=np.uint8)
+        record_id = None
+        for batch in self._fasta_batches(path, block_size):
+            bits = seq2bits(batch.seq)
+            bounds = [0, *batch.starts.tolist(), len(bits)]
+            # the first part continues the current record, the others start a new one
+            for j, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+                if j > 0:
+                    if record_id is not None:
+                        yield record_id, self._record_fcgr(counts)
+                    record_id = batch.ids[j-1]
+                    counts = np.zeros(4**self.k, dtype=np.int64)
+                    carry = carry[:0]
+                segment = np.concatenate((carry, bits[start:end]))
+                count_bits(segment, self.k, counts, self.sample_fraction)
+                carry = segment[max(len(segment)-self.k+1, 0):]
+        if record_id is not None:
+            yield record_id, self._record_fcgr(counts)
+
+    def _record_fcgr(self, counts):
+        with stage("pixels"):
+            return self.counts2fcgr(counts)
+
+    def _cached_table(self, compute, *key):
+        "Table (e.g. pixel_index) from the cache, if any"
+        if self.cache is None:
+            return compute()
+        return self.cache.get_or_compute(self.cache.key(*key), compute)
+
+    def _cached(self, compute, *key):
+        """FCGR of an input from the cache, if any. The key identifies the input (e.g. with a content hash),
+        it is combined with the class and options of the FCGR. Sparse FCGRs are not cached"""
+        if self.cache is None or self.sparse is True:
+            return compute()
+        options = (type(self).__name__, self.k, tuple(self.nucleotide_coords.items()), self.use_canonical_kmers,
+                   self.canonical_layout, self.dtype.name, self.sample_fraction)
+        return self.cache.get_or_compute(self.cache.key(*options, *key), compute)
+
+    def counts2fcgr(self, counts):
+        "Given the counts of each k-mer (indexed by its 2-bit code), returns the FCGR"
+        counts = self._rescale_sampled(counts)
+        if self.sparse is True:
+            return self._counts2sparse(counts)
+        return self._cast(self._counts2array(counts))
+
+    def _rescale_sampled(self, counts):
+        "expected counts of all the k-mers from the counts of the sampled ones"
+        if self.sample_fraction is None:
+            return counts
+        return counts / self.sample_fraction
+
+    def _layout(self,):
+        "cell of each k-mer (indexed by its 2-bit code) and shape of the output"
+        if self.use_canonical_kmers is True and self.canonical_layout == "compact":
+            return self.compact_index, (self.n_canonical,)
+        array_size = int(2**self.k)
+        return self.pixel_index, (array_size, array_size)
+
+    def _counts2array(self, counts):
+        "dense FCGR (without casting to the output dtype)"
+        index, shape = self._layout()
+        if self.use_canonical_kmers is True:
+            # several k-mers share the same cell
+            fcgr = np.bincount(index, weights=counts, minlength=int(np.prod(shape)))
+        else:
+            fcgr = np.zeros(int(np.prod(shape)), dtype=counts.dtype)
+            fcgr[index] = counts
+        return fcgr.reshape(shape)
+
+    def _counts2sparse(self, counts):
+        "sparse FCGR, without building the dense one"
+        index, shape = self._layout()
+        codes = np.flatnonzero(counts)
+        indices, inverse = np.unique(index[codes], return_inverse=True)
+        values = np.bincount(inverse, weights=counts[codes], minlength=len(indices))
+        return SparseFCGR(indices.astype(np.int64), self._cast(values), shape)
+
+    def _cast(self, fcgr):
+        "Cast to the output dtype, integer dtypes saturate at their maximum value"
+        return saturate(fcgr, self.dtype)
+
+    def pyramid(self, sequence: str, k_max: int = None, k_min: int = 1):
+        """Given a DNA sequence, returns a dict {k: FCGR} for k = k_min, ..., k_max (self.k by default),
+        counting the k-mers only once, for k_max.
+        
+        The 4 pixels of a 2x2 block of the FCGR for k are the k-mers with the same suffix of length k-1,
+        which is the pixel of that (k-1)-mer in the FCGR for k-1. So the FCGR for k-1 is the 2x2 sum-pooling 
+        of the FCGR for k, plus the (k-1)-mers that are not the suffix of a k-mer: the one at the start of
+        the sequence and the ones right after a non-ACGT symbol"""
+        if self.use_canonical_kmers is True or self.sparse is True or self.sample_fraction is not None:
+            raise ValueError("pyramid is available only for dense FCGRs without canonical k-mers or sampling")
+        k_max = k_max or self.k
+        coords = tuple(self.nucleotide_coords.items())
+        bits = seq2bits(sequence)
+
+        fcgr = np.zeros(4**k_max)
+        fcgr[pixel_index(k_max, coords)] = count_bits(bits, k_max)
+        fcgr = fcgr.reshape(2**k_max, 2**k_max)
+        fcgrs = {k_max: fcgr}
+
+        # positions of the k-mers without a previous nucleotide
+        starts = np.concatenate(([0], np.flatnonzero(bits == INVALID)+1))
+        for k in range(k_max-1, k_min-1, -1):
+            array_size = int(2**k)
+            fcgr = fcgr.reshape(array_size, 2, array_size, 2).sum(axis=(1,3))
+            
+            # correction for the k-mers that are not the suffix of a (k+1)-mer
+            first = starts[starts <= len(bits) - k]
+            kmers = bits[first[:,None] + np.arange(k)]
+            kmers = kmers[(kmers != INVALID).all(axis=1)].astype(np.int64)
+            codes = kmers @ (4**np.arange(k-1,-1,-1, dtype=np.int64))
+            np.add.at(fcgr.ravel(), pixel_index(k, coords)[codes], 1)
+            fcgrs[k] = fcgr
+
+        return {k: self._cast(fcgrs[k]) for k in range(k_min, k_max+1)}
+
+    def compact2dense(self, compact):
+        "Given a FCGR of canonical k-mers in the compact layout, returns the (2**k x 2**k) matrix"
+        if isinstance(compact, SparseFCGR):
+            compact = compact.todense()
+        codes = np.arange(4**self.k, dtype=np.int64)
+        is_canonical = canonical_codes(codes, self.k) == codes
+        counts = np.where(is_canonical, compact[self.compact_index], 0)
+        array_size = int(2**self.k)
+        fcgr = np.bincount(self.pixel_index, weights=counts, minlength=array_size**2)
+        return fcgr.reshape(array_size,array_size)
+
+    def batch(self, sequences, n_jobs: int = 1, dtype = None, path = None, chunksize: int = None, n: int = None):
+        """Given an iterable of DNA sequences (str or records with a .seq attribute, like Bio SeqRecord), 
+        returns an array (n, 2**k, 2**k) (or (n, n_canonical) in the compact layout) with their FCGRs,
+        in the same order as the input.
+        - n: number of sequences, needed if the input has no len() (e.g. Bio.SeqIO.parse)
+        - n_jobs: number of processes used (-1 to use all cpus)
+        - dtype: dtype of the output, the dtype of the FCGR by default
+        - path: if provided, the output is a .npy file memory-mapped in 'w+' mode
+        - chunksize: number of sequences sent to a process at once (at most BATCH_CHUNKSIZE by default)
+        Sequences are read from the input while they are processed: at most 2*n_jobs chunks are in memory
+        """
+        if self.sparse is True:
+            raise ValueError("batch is not available for sparse FCGRs")
+        if n is None:
+            if not hasattr(sequences, "__len__"):
+                raise ValueError("the number of sequences n is needed when the input has no len()")
+            n = len(sequences)
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        dtype = self.dtype if dtype is None else dtype
+        
+        # preallocate output
+        _, shape = self._layout()
+        shape = (n, *shape)
+        if path is None:
+            out = np.zeros(shape, dtype=dtype)
+        else:
+            out = np.lib.format.open_memmap(str(path), mode="w+", dtype=dtype, shape=shape)
+
+        if n_jobs == 1 or n <= 1:
+            n_read = 0
+            for seq in sequences:
+                if n_read == n:
+                    raise ValueError(f"more than n={n} sequences in the input")
+                out[n_read] = saturate(self(_as_sequence(seq)), dtype)
+                n_read += 1
+        else:
+            chunksize = chunksize or max(1, min(n // (4*n_jobs), BATCH_CHUNKSIZE))
+            n_read = self._batch_parallel(iter(sequences), n, n_jobs, chunksize, dtype, path, out)
+
+        if n_read != n:
+            raise ValueError(f"{n_read} sequences in the input, expected n={n}")
+        if path is not None:
+            out.flush()
+        return out
+
+    def _batch_parallel(self, sequences, n, n_jobs, chunksize, dtype, path, out):
+        "FCGRs of chunks of sequences in n_jobs processes, with at most 2*n_jobs chunks submitted at once"
+        n_read = 0
+        # the FCGR is sent once to each process, not for each chunk
+        with ProcessPoolExecutor(n_jobs, initializer=_init_batch_worker, initargs=(self,)) as pool:
+            pending = {}
+            while True:
+                while len(pending) < 2*n_jobs:
+                    chunk = [_as_sequence(seq) for seq in islice(sequences, chunksize)]
+                    if not chunk:
+                        break
+                    if n_read + len(chunk) > n:
+                        raise ValueError(f"more than n={n} sequences in the input")
+                    pending[pool.submit(_batch_worker, chunk, n_read, dtype, path)] = n_read
+                    n_read += len(chunk)
+                if not pending:
+                    return n_read
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    start = pending.pop(future)
+                    fcgrs = future.result()
+                    if fcgrs is not None:
+                        out[start:start+len(fcgrs)] = fcgrs
+
+    def fcgr_reference(self, sequence: str):
+        "Given a DNA sequence, returns an array with his FCGR. Dict-based implementation, kept as reference"
         self.count_kmers(sequence)
        
         # Create an empty array to save the FCGR values
@@ -39,7 +397,7 @@ class FCGR(CGR):
         # Assign frequency to each box in the matrix
         for kmer, freq in self.freq_kmer.items():        
             pos_x, pos_y = self.kmer2pixel[kmer]
-            fcgr[int(pos_x)-1,int(pos_y)-1] = freq
+            fcgr[int(pos_x)-1,int(pos_y)-1] += freq
         return fcgr
 
     def count_kmer(self, kmer):
@@ -70,6 +428,7 @@ class FCGR(CGR):
         return 2**self.k-int(y)+1, int(x)
 
     def kmer2pixel_position(self,):
+        "Pixel position of each k-mer computed from its CGR encoding"
         kmer2pixel = dict()
         for kmer in self.kmers:
             kmer2pixel[kmer] = self.pixel_position(kmer)
@@ -86,18 +445,23 @@ class FCGR(CGR):
         img_pil.save(path)
     
     def array2img(self, array):
-        "Array to PIL image"
+        "Array (or SparseFCGR) to PIL image, 8-bits (mode L) or 16-bits (mode I;16) grayscale"
+        from PIL import Image
+        if isinstance(array, SparseFCGR):
+            array = array.todense()
+        if self.bits not in (8, 16):
+            raise ValueError("images can be generated only with bits=8 or bits=16")
+        array = np.asarray(array, dtype=np.float64)
         m, M = array.min(), array.max()
         # rescale to [0,1]
-        img_rescaled = (array - m) / (M-m) 
+        img_rescaled = (array - m) / (M-m) if M > m else np.zeros_like(array)
         
         # invert colors black->white
         img_array = np.ceil(self.max_color - img_rescaled*self.max_color)
-        dtype = eval(f"np.int{self.bits}")
-        img_array = np.array(img_array, dtype=dtype)
+        img_array = img_array.astype(np.uint8 if self.bits == 8 else np.uint16)
         
-        # convert to Image 
-        img_pil = Image.fromarray(img_array,'L')
+        # convert to Image, the dtype gives the mode (L for uint8, I;16 for uint16)
+        img_pil = Image.fromarray(img_array)
         return img_pil
     
     # # --------------- canonical k-mers ---------------- # # 
@@ -111,8 +475,9 @@ class FCGR(CGR):
         return kmer if kmer < rev_complement else rev_complement
     
     def _kmer2pixel_canonical_kmers(self,):
+        "Pixel position of each k-mer computed from the CGR encoding of its canonical k-mer"
         # change pixel position of non-canonical kmers    
-        kmer2pixel = dict()
+        kmer2pixel = self.kmer2pixel_position()
         for kmer in self.kmers: 
             canonical_kmer = self.get_canonical_kmer(kmer)
             if kmer != canonical_kmer:      
@@ -0,0 +1,152 @@
+"Many FCGRs in a single memory-mapped file"
+import os
+import json
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+try:
+    import fcntl
+except ImportError: # not available on Windows, appends are not locked
+    fcntl = None
+
+MAGIC = b"FCGRDATA"
+HEADER_SIZE = 4096
+DATASET_DTYPES = ("uint8","uint16","float32")
+
+class FCGRDataset:
+    """
+    FCGRs of the same shape stored in one file, that can be read with zero-copy (memory-mapped) random access.
+
+    The file is a header of HEADER_SIZE bytes (MAGIC and the json with k, shape, dtype, id_size and metadata_size)
+    followed by one slot for each FCGR with:
+    id (utf-8, id_size bytes) | metadata (json, metadata_size bytes) | FCGR (fixed shape and dtype)
+    Slots have a fixed size, so the number of FCGRs is given by the size of the file, and several processes
+    can append to the same file: each append writes whole slots at the end of the file, under an exclusive lock.
+
+    >>> dataset = FCGRDataset.create("fcgrs.fcgr", k=6, dtype="uint16")
+    >>> dataset.append(fcgr(seq), id="seq1", metadata={"label": "virus"})
+    >>> dataset = FCGRDataset("fcgrs.fcgr")
+    >>> dataset[0], dataset[10:20], dataset.ids, dataset.metadata(0)
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with open(self.path, "rb") as fp:
+            header = fp.read(HEADER_SIZE)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a FCGR dataset")
+        self.header = json.loads(header[len(MAGIC):].rstrip(b"\0"))
+        self.k = self.header["k"]
+        self.shape = tuple(self.header["shape"])
+        self.dtype = np.dtype(self.header["dtype"])
+
+        # a slot is aligned to 8 bytes, so FCGRs can be read in place
+        id_size, metadata_size = self.header["id_size"], self.header["metadata_size"]
+        data_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.slot_dtype = np.dtype(dict(
+            names=["id","metadata","data"],
+            formats=[f"S{id_size}", f"S{metadata_size}", (self.dtype, self.shape)],
+            offsets=[0, id_size, id_size+metadata_size],
+            itemsize=-(-(id_size+metadata_size+data_size) // 8) * 8,
+        ))
+        self._slots = None
+        self._index = None
+
+    @classmethod
+    def create(cls, path: Union[str, Path], k: int, dtype = "uint16", shape: Optional[tuple] = None,
+               id_size: int = 64, metadata_size: int = 192, overwrite: bool = False):
+        """Create an empty dataset for FCGRs of k-mers.
+        - shape: (2**k, 2**k) by default, e.g. (2**k, 2**k, 2) for FCGRs with qualities, or (n,) for canonical k-mers in the compact layout
+        - dtype: one of uint8, uint16, float32. Integer dtypes saturate at their maximum value
+        - id_size, metadata_size: maximum size (in bytes) of the id and the json of the metadata of each FCGR"""
+        if np.dtype(dtype).name not in DATASET_DTYPES:
+            raise ValueError(f"dtype must be one of {', '.join(DATASET_DTYPES)}")
+        if id_size % 8 or metadata_size % 8:
+            raise ValueError("id_size and metadata_size must be multiples of 8")
+        shape = (2**k, 2**k) if shape is None else tuple(shape)
+        header = dict(k=k, shape=shape, dtype=np.dtype(dtype).name, id_size=id_size, metadata_size=metadata_size)
+        header = MAGIC + json.dumps(header).encode()
+        with open(path, "wb" if overwrite else "xb") as fp:
+            fp.write(header.ljust(HEADER_SIZE, b"\0"))
+        return cls(path)
+
+    def __len__(self,):
+        return (os.path.getsize(self.path) - HEADER_SIZE) // self.slot_dtype.itemsize
+
+    @property
+    def slots(self,) -> np.ndarray:
+        "memory-mapped slots (structured array with fields id, metadata and data), remapped if the file grew"
+        n = len(self)
+        if self._slots is None or len(self._slots) != n:
+            if n == 0:
+                return np.zeros(0, dtype=self.slot_dtype)
+            self._slots = np.memmap(self.path, dtype=self.slot_dtype, mode="r", offset=HEADER_SIZE, shape=(n,))
+            self._index = None
+        return self._slots
+
+    @property
+    def data(self,) -> np.ndarray:
+        "All the FCGRs as an (n, *shape) array, a strided view of the file"
+        return self.slots["data"]
+
+    def __getitem__(self, idx):
+        "FCGR (or FCGRs) by position, without copying them"
+        return self.data[idx]
+
+    @property
+    def ids(self,) -> List[str]:
+        return [id.decode() for id in self.slots["id"]]
+
+    def metadata(self, idx: int) -> Dict:
+        return json.loads(self.slots["metadata"][idx] or b"{}")
+
+    def position(self, id: str) -> int:
+        "Position of an FCGR by its id"
+        if self._index is None or len(self._index) != len(self.slots):
+            self._index = {id: pos for pos, id in enumerate(self.ids)}
+        return self._index[id]
+
+    def get(self, id: str) -> np.ndarray:
+        "FCGR by its id"
+        return self[self.position(id)]
+
+    def append(self, fcgr: np.ndarray, id: str, metadata: Optional[Dict] = None):
+        "Add an FCGR at the end of the file"
+        self.extend(np.asarray(fcgr)[None], [id], None if metadata is None else [metadata])
+
+    def extend(self, fcgrs: np.ndarray, ids: List[str], metadata: Optional[List[Dict]] = None):
+        "Add FCGRs at the end of the file, written at once (safe with several processes appending)"
+        fcgrs = np.asarray(fcgrs)
+        if fcgrs.shape[1:] != self.shape:
+            raise ValueError(f"FCGRs must have shape {self.shape}, not {fcgrs.shape[1:]}")
+        if len(ids) != len(fcgrs) or (metadata is not None and len(metadata) != len(fcgrs)):
+            raise ValueError("an id (and metadata, if provided) is needed for each FCGR")
+
+        slots = np.zeros(len(fcgrs), dtype=self.slot_dtype)
+        slots["id"] = self._encode(ids, "id")
+        if metadata is not None:
+            slots["metadata"] = self._encode([json.dumps(m) for m in metadata], "metadata")
+        if np.issubdtype(self.dtype, np.integer):
+            fcgrs = np.clip(fcgrs, 0, np.iinfo(self.dtype).max)
+        slots["data"] = fcgrs
+
+        with open(self.path, "ab") as fp:
+            if fcntl is not None:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                fp.write(slots.tobytes())
+                fp.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _encode(self, values: List[str], field: str) -> List[bytes]:
+        "utf-8 values that fit in their field"
+        size = self.slot_dtype.fields[field][0].itemsize
+        encoded = [str(value).encode() for value in values]
+        if any(len(value) > size for value in encoded):
+            raise ValueError(f"{field} larger than {size} bytes, create the dataset with a larger {field}_size")
+        return encoded
+
+    def __repr__(self,):
+        return f"FCGRDataset(path={str(self.path)!r}, k={self.k}, shape={self.shape}, dtype={self.dtype}, n={len(self)})"
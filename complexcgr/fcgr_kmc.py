@@ -1,23 +1,177 @@
 from . import FCGR
+from .fastx import iter_blocks, NEWLINE, CARRIAGE_RETURN
+from .kmers import NUC2BITS, INVALID
+from .instrumentation import stage, timed_iter
+from .cache import hash_file
 
+import os
 import gzip
 import numpy as np
+from pathlib import Path
+
+# KMC database (.kmc_pre/.kmc_suf) format supported, used by KMC 2 and KMC 3
+KMC_VERSION = 0x200
+
+def read_kmc_header(path_pre):
+    """Read the header of a .kmc_pre file, and the size (in bytes) of its LUTs.
+    The file is: 'KMCP' | LUTs (uint64) | signature map (uint32) | header | header_offset (uint32) | 'KMCP'
+    and the last 4 bytes of the header are the version of the format"""
+    with open(str(path_pre), "rb") as fp:
+        if fp.read(4) != b"KMCP":
+            raise ValueError(f"{path_pre} is not a KMC database")
+        size = fp.seek(0, os.SEEK_END)
+        fp.seek(-12, os.SEEK_END)
+        version, header_offset = np.frombuffer(fp.read(8), dtype="<u4").tolist()
+        if version != KMC_VERSION:
+            raise ValueError(f"KMC database version {hex(version)} not supported, only {hex(KMC_VERSION)} (KMC 2 and 3)")
+        fp.seek(-(header_offset+8), os.SEEK_END)
+        header = fp.read(header_offset)
+
+    fields = ("kmer_length","mode","counter_size","lut_prefix_length","signature_len","min_count","max_count")
+    kmc_header = dict(zip(fields, np.frombuffer(header[:28], dtype="<u4").tolist()))
+    kmc_header["total_kmers"] = int(np.frombuffer(header[28:36], dtype="<u8")[0])
+    kmc_header["both_strands"] = header[36] == 0
+    
+    signature_map_size = 4 * (4**kmc_header["signature_len"] + 1)
+    kmc_header["lut_size"] = size - 4 - signature_map_size - header_offset - 8
+    return kmc_header
+
+def read_kmc_database(path, block_size: int = 2**20):
+    """Iterate over the k-mers of a KMC database (path without the .kmc_pre/.kmc_suf extension) 
+    in blocks of (2-bit codes, counts). Both files are memory-mapped.
+    
+    Each k-mer is split in a prefix (lut_prefix_length nucleotides) and a suffix. The .kmc_suf file 
+    has one record for each k-mer with its suffix (4 nucleotides per byte) and its counter (little endian).
+    The .kmc_pre file has one LUT per bin with the index of the first record of each prefix, 
+    so the prefix of a record is the position of the last LUT entry not greater than its index.
+    """
+    header = read_kmc_header(f"{path}.kmc_pre")
+    if header["mode"] != 0:
+        raise ValueError("only KMC databases with integer counters (mode 0) are supported")
+    k, prefix_len = header["kmer_length"], header["lut_prefix_length"]
+    suffix_size, counter_size = (k - prefix_len) // 4, header["counter_size"]
+    total_kmers = header["total_kmers"]
+
+    # LUTs of all bins, plus a sentinel after the last record
+    luts = np.memmap(f"{path}.kmc_pre", dtype="<u8", mode="r", offset=4, shape=(header["lut_size"]//8,))
+    prefix_mask = 4**prefix_len - 1
+
+    record_size = suffix_size + counter_size
+    records = np.memmap(f"{path}.kmc_suf", dtype=np.uint8, mode="r", offset=4, shape=(total_kmers, record_size))
+    suffix_weights = 256**np.arange(suffix_size-1, -1, -1, dtype=np.uint64)
+    counter_weights = 256**np.arange(counter_size, dtype=np.uint64)
+    
+    for start in range(0, total_kmers, block_size):
+        block = np.asarray(records[start:start+block_size], dtype=np.uint64)
+        index = np.arange(start, start+len(block), dtype=np.uint64)
+        prefixes = (np.searchsorted(luts, index, side="right") - 1) & prefix_mask
+        suffixes = block[:,:suffix_size] @ suffix_weights
+        codes = (prefixes.astype(np.uint64) << np.uint64(2*(k-prefix_len))) | suffixes
+        counts = block[:,suffix_size:] @ counter_weights
+        yield codes.astype(np.int64), counts.astype(np.int64)
 
 class FCGRKmc(FCGR):
     """
     Create FCGR with the option of using canonical kmers from KMC output
     """
-    def __init__(self, k: int, use_canonical_kmers: bool=False):
-        super().__init__(k, use_canonical_kmers)
+    def __init__(self, k: int, use_canonical_kmers: bool=False, canonical_layout: str = "dense",
+                 dtype = "float64", sparse: bool = False, cache = None):
+        super().__init__(k, use_canonical_kmers, canonical_layout=canonical_layout, dtype=dtype, sparse=sparse, cache=cache)
         self.k = k # k-mer representation
         self.use_canonical_kmers = use_canonical_kmers
 
     def __call__(self, path_kmc_output):
-        "Given a path to a kmc output file, return the FCGR using canonical kmers as an array"
+        """Given a path to a kmc output file (plain or gzipped), return the FCGR using canonical kmers as an array.
+        The path can also be a KMC database (with or without the .kmc_pre/.kmc_suf extension)"""
+        if self.is_kmc_database(path_kmc_output):
+            return self.from_kmc_database(path_kmc_output)
+        key = ("kmc_dump", hash_file(path_kmc_output)) if self.cache is not None else ()
+        return self._cached(lambda: self._fcgr_dump(path_kmc_output), *key)
+
+    def _fcgr_dump(self, path_kmc_output):
+        counts = np.zeros(4**self.k, dtype=np.int64)
+
+        # parse complete lines of each block, the incomplete line at the end is carried to the next block
+        pending = b""
+        for block in timed_iter(iter_blocks(path_kmc_output)):
+            data = pending + block
+            with stage("counting"):
+                consumed = self.count_dump_lines(np.frombuffer(data, dtype=np.uint8), counts)
+            pending = data[consumed:]
+        if pending.strip():
+            with stage("counting"):
+                self.count_dump_lines(np.frombuffer(pending + b"\n", dtype=np.uint8), counts)
+
+        with stage("pixels"):
+            return self.counts2fcgr(counts)
+
+    @staticmethod
+    def is_kmc_database(path):
+        path = str(path)
+        return path.endswith((".kmc_pre",".kmc_suf")) or Path(f"{path}.kmc_pre").exists()
+
+    def from_kmc_database(self, path_kmc_db):
+        "Given a KMC database (.kmc_pre and .kmc_suf files), return the FCGR, without dumping the k-mers to a text file"
+        path_kmc_db = str(path_kmc_db)
+        if path_kmc_db.endswith((".kmc_pre",".kmc_suf")):
+            path_kmc_db = path_kmc_db[:-len(".kmc_pre")]
+
+        kmer_length = read_kmc_header(f"{path_kmc_db}.kmc_pre")["kmer_length"]
+        if kmer_length != self.k:
+            raise ValueError(f"the KMC database has {kmer_length}-mers, but the FCGR uses {self.k}-mers")
+        key = ("kmc_database", hash_file(f"{path_kmc_db}.kmc_pre"), hash_file(f"{path_kmc_db}.kmc_suf")) if self.cache is not None else ()
+        return self._cached(lambda: self._fcgr_database(path_kmc_db), *key)
+
+    def _fcgr_database(self, path_kmc_db):
+        counts = np.zeros(4**self.k, dtype=np.int64)
+        for codes, freqs in timed_iter(read_kmc_database(path_kmc_db)):
+            with stage("counting"):
+                counts += np.bincount(codes, weights=freqs, minlength=len(counts)).astype(np.int64)
+        with stage("pixels"):
+            return self.counts2fcgr(counts)
+
+    def count_dump_lines(self, buffer: np.ndarray, counts: np.ndarray):
+        """Add the counts of the complete lines 'kmer<tab>count' of a block of a kmc dump
+        to a flat array of 4**k cells. Returns the number of bytes consumed"""
+        k = self.k
+        newlines = np.flatnonzero(buffer == NEWLINE)
+        if len(newlines) == 0:
+            return 0
+        starts = np.concatenate(([0], newlines[:-1]+1))
+        ends = newlines - (buffer[newlines-1] == CARRIAGE_RETURN)
+
+        # skip empty lines
+        not_empty = ends > starts
+        starts, ends = starts[not_empty], ends[not_empty]
+        if (ends - starts < k+2).any() or (buffer[starts+k] > ord(" ")).any():
+            raise ValueError(f"each line of the kmc dump must be a {k}-mer followed by its count")
+
+        # 2-bit code of each k-mer
+        bits = NUC2BITS[buffer[starts[:,None] + np.arange(k)]]
+        if (bits == INVALID).any():
+            raise ValueError("k-mers of the kmc dump must contain only A,C,G,T")
+        codes = bits.astype(np.int64) @ (4**np.arange(k-1,-1,-1, dtype=np.int64))
+
+        # counts, right-aligned digits up to the end of the line
+        n_digits = ends - (starts+k+1)
+        max_digits = int(n_digits.max())
+        positions = ends[:,None] - max_digits + np.arange(max_digits)
+        digits = buffer[positions].astype(np.int64) - ord("0")
+        is_digit = np.arange(max_digits) >= (max_digits - n_digits)[:,None]
+        if ((digits < 0) | (digits > 9))[is_digit].any():
+            raise ValueError("counts of the kmc dump must be integers")
+        digits[~is_digit] = 0
+        freqs = digits @ (10**np.arange(max_digits-1,-1,-1, dtype=np.int64))
+
+        counts += np.bincount(codes, weights=freqs, minlength=len(counts)).astype(np.int64)
+        return int(newlines[-1]+1)
+
+    def fcgr_reference(self, path_kmc_output):
+        "Given a path to a kmc output file, return the FCGR. Line by line implementation, kept as reference"
         # Create an empty array to save the FCGR values
         array_size = int(2**self.k)
         fcgr = np.zeros((array_size,array_size))
-        
+
         if str(path_kmc_output).endswith(".txt"):
             with open(path_kmc_output) as fp:
                 for line in fp:
@@ -31,5 +185,5 @@ class FCGRKmc(FCGR):
                     kmer, freq = line.split()
                     pos_x, pos_y = self.kmer2pixel[kmer]
                     fcgr[int(pos_x)-1,int(pos_y)-1] += int(freq)
-                    
-        return fcgr
\ No newline at end of file
+
+        return fcgr
@@ -1,97 +1,211 @@
+import os
 import numpy as np
-from Bio import SeqIO
-from collections import defaultdict
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 from pathlib import Path
-from tqdm import tqdm
 from typing import List, Union
-from complexcgr import FCGR 
+from complexcgr import FCGR
+from .fastx import FastxReader, fastq_split_points, open_binary, is_gzipped
+from .kmers import seq2bits, kmer_codes, accumulate, sliding_min, sample_table, block_bases, BLOCK_SIZE
+from .cache import hash_file
+from .instrumentation import Instrument, Recorder, stage, progress, timed_iter, record_stats, get_instrument
 
 # input for FCGR Samples
 _path_fastq = Union[str, Path] # path can be a string or a Path instance
 _fastq = Union[_path_fastq,List[_path_fastq]] # either a single path or a list of paths to fastq files
 
+# plain fastq files larger than this (in bytes) are split across processes
+SPLIT_SIZE = 2**26
+
+# FCGRSamples and shared arrays (counts, qualities) used by each process
+_samples_fcgr = None
+_samples_arrays = None
+
+def _init_samples_worker(fcgr, shm_names, next_slot, consider_quality):
+    global _samples_fcgr, _samples_arrays
+    with next_slot.get_lock():
+        slot = next_slot.value
+        next_slot.value += 1
+    # the parent process owns (and unlinks) the shared memory
+    shm = shared_memory.SharedMemory(name=shm_names[slot])
+    n_arrays = 2 if consider_quality is True else 1
+    _samples_fcgr = fcgr
+    _samples_arrays = (shm, np.ndarray((n_arrays, 4**fcgr.k), dtype=np.int64, buffer=shm.buf))
+
+def _samples_worker(path, start, end, min_quality, instrumented):
+    "Count k-mers on a range of bytes of a file. Returns the stats of each stage, if instrumented"
+    _, arrays = _samples_arrays
+    quals = arrays[1] if len(arrays) == 2 else None
+    with Recorder() if instrumented else Instrument() as recorder:
+        for batch in timed_iter(_samples_fcgr.load_fastq(path, start, end)):
+            _samples_fcgr.count_batch(batch, arrays[0], quals, min_quality)
+    return getattr(recorder, "stats", {})
+
+def _task_size(task):
+    "Number of bytes of a (path, start, end) task, end is None for a whole file"
+    path, start, end = task
+    return (os.path.getsize(path) if end is None else end) - start
+
 class FCGRSamples(FCGR):
 
-    def __init__(self, k: int, bits: int = 8):
-        super().__init__(k, bits)
-
-    def __call__(self, path_fastq: _fastq, consider_quality: bool = False):
-        "Given a (list) of fastq files, return the FCGR matrix" 
-        
-        ## ---- New for reads ---- 
-    
-        # for each call, we start to count the frequencies
-        self.freq_kmer = defaultdict(int)
-        if consider_quality is True:
-            self.qual_kmer = defaultdict(int)
-        
+    def __init__(self, k: int, bits: int = 8, use_canonical_kmers: bool = False, canonical_layout: str = "dense",
+                 dtype = "float64", sparse: bool = False, cache = None, sample_fraction: float = None):
+        super().__init__(k, use_canonical_kmers, bits=bits, canonical_layout=canonical_layout, dtype=dtype, sparse=sparse,
+                         cache=cache, sample_fraction=sample_fraction)
+
+    def __call__(self, path_fastq: _fastq, consider_quality: bool = False, n_jobs: int = 1, min_quality: int = None):
+        """Given a (list) of fastq files, return the FCGR matrix
+        - consider_quality: add a second channel with the mean quality of each k-mer
+        - min_quality: if provided, k-mers with a nucleotide with a (phred) quality below it are not counted
+        - n_jobs: number of processes used (-1 to use all cpus). Files, and ranges of bytes of large 
+          plain fastq files, are split across processes, each one counting in its own shared array
+        To show a progress bar, call it inside 'with complexcgr.instrumentation.ProgressBar():'"""
+
+        if consider_quality is True and self.sparse is True:
+            raise ValueError("sparse FCGRs are not available with consider_quality=True")
+
         # transform to list to iterate
         path_fastq = path_fastq if type(path_fastq) is list else [path_fastq]
-        
-        # For each file, count kmers on their reads
-        for path in path_fastq: 
-            fastq = self.load_fastq(path)
-            n_reads = self.count_reads(path)
-
-            # count kmers in each read
-            for sample in tqdm(fastq,total=n_reads,desc=f"Counting kmers on {str(Path(path).stem)}"):
-                read = sample.seq
-                if consider_quality is True:
-                    qual = sample.letter_annotations["phred_quality"]
-                    self.count_kmers_qualities(str(read),qual)
-                else:
-                    self.count_kmers(str(read))
-
-        ## ---- End new for reads ----
-
-        # Create an empty array to save the FCGR values
-        if consider_quality is False:
-            array_size = int(2**self.k)
-            fcgr = np.zeros((array_size,array_size))
+        if self.cache is not None:
+            key = ("fastq", tuple(hash_file(path) for path in path_fastq), consider_quality, min_quality)
+            return self._cached(lambda: self._fcgr_fastq(path_fastq, consider_quality, n_jobs, min_quality), *key)
+        return self._fcgr_fastq(path_fastq, consider_quality, n_jobs, min_quality)
+
+    def _fcgr_fastq(self, path_fastq, consider_quality, n_jobs, min_quality):
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+
+        if n_jobs == 1:
+            # counts (and sum of qualities) of each k-mer, indexed by its 2-bit code
+            counts = np.zeros(4**self.k, dtype=np.int64)
+            quals = np.zeros(4**self.k, dtype=np.int64) if consider_quality is True else None
+
+            # For each file, count kmers on their reads
+            for path in path_fastq:
+                # the size of the file is known in advance only if it is not compressed
+                total = os.path.getsize(path) if not is_gzipped(path) else None
+                with progress(f"Counting kmers on {str(Path(path).stem)}", total):
+                    for batch in timed_iter(self.load_fastq(path)):
+                        self.count_batch(batch, counts, quals, min_quality)
         else:
-            array_size = int(2**self.k)
-            fcgr = np.zeros((array_size,array_size,2))
+            counts, quals = self._count_parallel(path_fastq, consider_quality, n_jobs, min_quality)
 
         # Assign frequency to each box in the matrix
-        for kmer, freq in self.freq_kmer.items():        
-            pos_x, pos_y = self.kmer2pixel[kmer]
-            
-            if consider_quality is True:
-                fcgr[int(pos_x)-1,int(pos_y)-1,0] = freq
-                fcgr[int(pos_x)-1,int(pos_y)-1,1] = self.qual_kmer[kmer]
-            else:
-                fcgr[int(pos_x)-1,int(pos_y)-1] = freq
-
-        return fcgr  if consider_quality is False else self.rescale_fcgr_qualities(fcgr)
-        
-
-    def load_fastq(self, path): 
-        "Load a fastq file"
-        fastq = SeqIO.parse(str(path), "fastq")
-        return fastq
+        with stage("pixels"):
+            if consider_quality is False:
+                return self.counts2fcgr(counts)
+
+            # the quality of a k-mer is the mean of its nucleotides' qualities
+            fcgr = np.stack([self._counts2array(counts), self._counts2array(quals / self.k)], axis=-1)
+            fcgr = self.rescale_fcgr_qualities(fcgr.astype(np.float64))
+            # the mean qualities are not affected by the sampling, only the counts
+            fcgr[...,0] = self._rescale_sampled(fcgr[...,0])
+            return self._cast(fcgr)
+
+    def _count_parallel(self, path_fastq, consider_quality, n_jobs, min_quality=None):
+        "Count k-mers with n_jobs processes, each one accumulating in its own array in shared memory"
+        tasks = self.split_tasks(path_fastq, n_jobs)
+        n_arrays = 2 if consider_quality is True else 1
+        n_bytes = 8 * 4**self.k * n_arrays
+        shms = [shared_memory.SharedMemory(create=True, size=n_bytes) for _ in range(n_jobs)]
+        try:
+            for shm in shms:
+                np.ndarray((n_arrays, 4**self.k), dtype=np.int64, buffer=shm.buf)[:] = 0
+
+            # each process takes one of the shared arrays when it starts
+            next_slot = mp.Value("i", 0)
+            initargs = (self, [shm.name for shm in shms], next_slot, consider_quality)
+            instrumented = get_instrument().enabled
+            with ProcessPoolExecutor(n_jobs, initializer=_init_samples_worker, initargs=initargs) as pool:
+                futures = [pool.submit(_samples_worker, *task, min_quality, instrumented) for task in tasks]
+                # bytes read are uncompressed, the total is known only for plain files
+                gzipped = any(is_gzipped(task[0]) for task in tasks)
+                with progress("Counting kmers", None if gzipped else sum(_task_size(task) for task in tasks)):
+                    for future in as_completed(futures):
+                        record_stats(future.result())
+
+            # reduce the arrays of all processes
+            arrays = sum(np.ndarray((n_arrays, 4**self.k), dtype=np.int64, buffer=shm.buf) for shm in shms)
+            counts = arrays[0].copy()
+            quals = arrays[1].copy() if consider_quality is True else None
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+        return counts, quals
 
-    def count_kmers(self, read: str): 
+    @staticmethod
+    def split_tasks(path_fastq, n_jobs: int, split_size: int = None):
+        """Split the input in (path, start, end) ranges of bytes. Plain fastq files larger than split_size 
+        are split in record boundaries, gzipped files (and fasta files) are processed as a whole (end=None)"""
+        split_size = split_size or SPLIT_SIZE
+        tasks = []
+        for path in path_fastq:
+            size = os.path.getsize(path)
+            # offsets of gzipped files are in the decompressed stream, they can't be split
+            gzipped = is_gzipped(path)
+            with open_binary(path) as fp:
+                is_fastq = fp.read(1) == b"@"
+            if is_fastq and not gzipped and size > split_size:
+                n_parts = min(-(-size // split_size), 4*n_jobs)
+                points = fastq_split_points(path, n_parts)
+                tasks.extend((path, start, end) for start, end in zip(points[:-1], points[1:]))
+            else:
+                tasks.append((path, 0, None))
+        # larger tasks first for a better balance between processes
+        return sorted(tasks, key=_task_size, reverse=True)
+
+    def load_fastq(self, path, start: int = 0, end: int = None):
+        "Load a fastq (or fasta) file, plain or gzipped, as an iterator of batches of reads"
+        return FastxReader(path, overlap=self.k-1, start=start, end=end)
+
+    def count_batch(self, batch, counts, quals=None, min_quality: int = None):
+        """Count k-mers (and the sum of their qualities) of a batch of reads in flat arrays of 4**k cells.
+        Reads are separated by newlines in the batch, so k-mers are never counted across reads.
+        The quality of each k-mer is the sum of the phred qualities of its nucleotides, 
+        computed for all the k-mers at once from the cumulative sum of the qualities.
+        If min_quality is provided, k-mers with a nucleotide with quality below it are not counted.
+        With sample_fraction, only the sampled k-mers are counted (see kmers.frac_sample)"""
+        k = self.k
+        if (quals is not None or min_quality is not None) and batch.qual is None:
+            raise ValueError("qualities are available only for fastq files")
+
+        bits = seq2bits(batch.seq)
+        sampled = None if self.sample_fraction is None else sample_table(k, self.sample_fraction)
+        n_kmers = len(bits)-k+1
+        for start in range(0, max(n_kmers, 0), BLOCK_SIZE):
+            end = start+BLOCK_SIZE+k-1
+            # the newline separating each read is not a base
+            separators = batch.n_reads if start == 0 else 0
+            with stage("kmers", bases=block_bases(start, n_kmers, k, BLOCK_SIZE) - separators):
+                codes, valid = kmer_codes(bits[start:end], k)
+                if quals is not None or min_quality is not None:
+                    qual = batch.qual[start:end].astype(np.int64) - 33
+                if min_quality is not None:
+                    valid &= sliding_min(qual, k) >= min_quality
+                if sampled is not None:
+                    valid &= sampled[codes]
+
+            with stage("counting"):
+                accumulate(codes[valid], counts)
+                if quals is not None:
+                    cumsum = np.concatenate(([0], np.cumsum(qual)))
+                    qual_kmers = cumsum[k:] - cumsum[:-k]
+                    quals += np.bincount(codes[valid], weights=qual_kmers[valid], minlength=len(quals)).astype(np.int64)
+
+    # # --------------- reference implementation (dict-based) ---------------- # #
+    def count_kmers(self, read: str):
         # representativity of kmers
-        last_j = len(read) - self.k + 1   
+        last_j = len(read) - self.k + 1
         kmers  = (read[i:(i+self.k)] for i in range(last_j))
         # count kmers in a dictionary
-        list(self.count_kmer(kmer) for kmer in kmers)        
-
-    @staticmethod
-    def count_reads(path):
-        "Count reads in a file to define progress bar"
-        n_reads = 0
-        with open(str(path)) as fp: 
-            for line in fp: 
-                if line.startswith("@"): 
-                    n_reads += 1
-        return n_reads
+        list(self.count_kmer(kmer) for kmer in kmers)
 
     def count_kmer(self, kmer):
         if "N" not in kmer:
             self.freq_kmer[kmer] += 1
 
-    
+
     def count_kmer_quality(self, kmer, qmer):
         """Count kmers and qualities
         For quality of a kmer, the mean of qualities for each nucleotide in the kmer will be saved"""
@@ -103,16 +217,16 @@ class FCGRSamples(FCGR):
         "Count kmers and qualities"
 
         # representativity of kmers
-        last_j = len(read) - self.k + 1   
-        kmers  = (read[i:(i+self.k)] for i in range(last_j)) 
+        last_j = len(read) - self.k + 1
+        kmers  = (read[i:(i+self.k)] for i in range(last_j))
         qmers  = (np.array(qual[i:(i+self.k)]) for i in range(last_j)) # qualities for each kmer
-        
+
         # count kmers and qualities in a dictionary
         list(self.count_kmer_quality(kmer,qmer) for (kmer,qmer) in zip(kmers,qmers))
 
     @staticmethod
     def rescale_fcgr_qualities(fcgr):
         "Divide each cumulate quality by the freq of its kmer"
-        freqs, quals = fcgr[:,:,0], fcgr[:,:,1]
-        fcgr[:,:,1] = np.divide(quals, freqs, out = np.zeros_like(quals), where = quals!=0)
-        return fcgr
\ No newline at end of file
+        freqs, quals = fcgr[...,0], fcgr[...,1]
+        fcgr[...,1] = np.divide(quals, freqs, out = np.zeros_like(quals), where = quals!=0)
+        return fcgr
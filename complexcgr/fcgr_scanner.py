@@ -0,0 +1,72 @@
+from . import FCGR
+from .kmers import seq2bits, kmer_codes, accumulate
+
+from typing import Callable, Optional
+import numpy as np
+
+class FCGRScanner(FCGR):
+    """
+    FCGRs of the windows of a sequence, e.g. 50 kb windows every 1 kb along a chromosome.
+    A single array of counts is kept: when the window moves, the k-mers that leave the window
+    are subtracted and the ones that enter are added, so the cost of each step depends on the step,
+    not on the window.
+    """
+    def __init__(self, k: int, window: int, step: int, use_canonical_kmers: bool = False, dtype = "float64"):
+        super().__init__(k, use_canonical_kmers, dtype=dtype)
+        if window < k or step < 1:
+            raise ValueError("window must be at least k, and step at least 1")
+        self.window = window
+        self.step = step
+
+    def __call__(self, sequence: str, reference: Optional[np.ndarray] = None, reduce: Optional[Callable] = None):
+        """Given a DNA sequence, yields (start, FCGR) for each window sequence[start:start+window].
+        - reference: yields (start, euclidean distance between the FCGR of the window and reference) instead,
+          updated only in the pixels that change at each step.
+        - reduce: yields (start, reduce(FCGR)) instead, e.g. reduce=lambda fcgr: fcgr.max()
+        """
+        index, shape = self._layout()
+        bits = seq2bits(sequence)
+        n_kmers = self.window - self.k + 1 # k-mers in a window
+        if len(bits) < self.window:
+            return
+
+        # counts of each cell of the FCGR in the current window
+        counts = np.zeros(int(np.prod(shape)), dtype=np.int64)
+        cells = self._cells(bits, 0, n_kmers, index)
+        accumulate(cells, counts)
+
+        if reference is not None:
+            reference = np.asarray(reference, dtype=np.float64).ravel()
+            sq_distance = float(((counts - reference)**2).sum())
+
+        start = 0
+        while True:
+            if reference is not None:
+                yield start, np.sqrt(max(sq_distance, 0.0))
+            else:
+                fcgr = self._cast(counts.reshape(shape))
+                yield start, fcgr if reduce is None else reduce(fcgr)
+
+            next_start = start + self.step
+            if next_start + self.window > len(bits):
+                return
+
+            # k-mers in the current window but not in the next one, and vice versa
+            leaving = self._cells(bits, start, min(next_start, start+n_kmers), index)
+            entering = self._cells(bits, max(start+n_kmers, next_start), next_start+n_kmers, index)
+
+            changed, inverse = np.unique(np.concatenate((leaving, entering)), return_inverse=True)
+            delta = np.bincount(inverse, weights=np.repeat([-1, 1], [len(leaving), len(entering)]), minlength=len(changed))
+            delta = delta.astype(np.int64)
+            if reference is not None:
+                before = counts[changed] - reference[changed]
+                sq_distance += float(((before + delta)**2 - before**2).sum())
+            counts[changed] += delta
+            start = next_start
+
+    def _cells(self, bits, first, last, index):
+        "cell in the FCGR of the valid k-mers starting at positions [first,last)"
+        if last <= first:
+            return np.zeros(0, dtype=np.int64)
+        codes, valid = kmer_codes(bits[first:last+self.k-1], self.k)
+        return index[codes[valid]].astype(np.int64)
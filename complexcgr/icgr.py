@@ -1,9 +1,9 @@
 "From original work: CGR for gene structure"
 from itertools import product
-from tqdm import tqdm
 from typing import Dict, Optional 
 from collections import defaultdict, namedtuple
 import numpy as np
+from .kmers import kmers2array, pack_digits, unpack_digits
 
 # coordinates for x+iy
 Coord = namedtuple("Coord", ["x","y"])
@@ -19,13 +19,22 @@ class iCGR:
     def __init__(self, coords: Optional[Dict[chr,tuple]]=None):
         self.nucleotide_coords = DEFAULT_COORDS if coords is None else coords
         self.cgr_coords = CGRCoords(0,0,0)
+        self.coords2nucleotide = {Coord(*coord): nucleotide for nucleotide, coord in self.nucleotide_coords.items()}
+
+        # bit-planes: each nucleotide sets a bit in x (and y) if its coordinate is +1 (and not if it is -1)
+        # only possible if the coordinates of the nucleotides are the 4 corners (+-1,+-1)
+        self.use_bitplanes = sorted(map(tuple, self.nucleotide_coords.values())) == [(-1,-1),(-1,1),(1,-1),(1,1)]
+        if self.use_bitplanes:
+            self.nuc2bit = np.full((256,2), 2, dtype=np.uint8) # 2 for symbols without coordinates
+            self.bits2nuc = np.zeros((2,2), dtype=np.uint8)
+            for nucleotide, (x,y) in self.nucleotide_coords.items():
+                bx, by = int(x > 0), int(y > 0)
+                self.nuc2bit[ord(nucleotide)] = bx, by
+                self.bits2nuc[bx, by] = ord(nucleotide)
     
     def nucleotide_by_coords(self,x,y):
         "Get nucleotide by coordinates (x,y)"
-        # filter nucleotide by coordinates
-        filtered = dict(filter(lambda item: item[1] == Coord(x,y), self.nucleotide_coords.items()))
-
-        return list(filtered.keys())[0]
+        return self.coords2nucleotide[Coord(x,y)]
 
     def forward(self, nucleotide: str): 
         "Compute next CGR coordinates"
@@ -33,8 +42,8 @@ class iCGR:
         N = self.cgr_coords.N 
 
         # compute next coordinates
-        x = self.cgr_coords.x + self.nucleotide_coords.get(nucleotide).x * 2**N
-        y = self.cgr_coords.y + self.nucleotide_coords.get(nucleotide).y * 2**N
+        x = self.cgr_coords.x + (self.nucleotide_coords.get(nucleotide).x << N)
+        y = self.cgr_coords.y + (self.nucleotide_coords.get(nucleotide).y << N)
         
         # update cgr_coords: iCGR starts in the corner of the first nucleotide
         
@@ -56,8 +65,8 @@ class iCGR:
         N = self.cgr_coords.N
         
         # update coordinates to the previous one
-        x = self.cgr_coords.x - self.nucleotide_coords.get(nucleotide).x * 2**(N-1)
-        y = self.cgr_coords.y - self.nucleotide_coords.get(nucleotide).y * 2**(N-1)
+        x = self.cgr_coords.x - (self.nucleotide_coords.get(nucleotide).x << (N-1))
+        y = self.cgr_coords.y - (self.nucleotide_coords.get(nucleotide).y << (N-1))
         
         # update cgr_coords
         self.cgr_coords = CGRCoords(self.cgr_coords.N-1,x,y)
@@ -70,18 +79,70 @@ class iCGR:
         return x,y
 
     def encode(self, sequence: str):
-        "From DNA sequence to CGR"
-        # reset starting position to (0,0,0)
-        self.reset_coords()
-        for nucleotide in sequence:
-            self.forward(nucleotide)
+        """From DNA sequence to CGR.
+        x = sum c_i*2**i, with c_i = +-1 the x-coordinate of the i-th nucleotide, is 2*Bx - (2**N-1) 
+        where Bx is the integer whose i-th bit is 1 if c_i = +1 (same for y). 
+        The bits of all the nucleotides are packed and converted to integers at once"""
+        if not self.use_bitplanes:
+            return self.encode_reference(sequence)
+        bits = self.nuc2bit[np.frombuffer(sequence.encode("ascii", errors="replace"), dtype=np.uint8)]
+        if (bits == 2).any():
+            raise ValueError(f"sequence must contain only {list(self.nucleotide_coords)}")
+        N = len(bits)
+        Bx, By = (int.from_bytes(np.packbits(bits[:,axis], bitorder="little").tobytes(), "little") for axis in (0,1))
+        self.cgr_coords = CGRCoords(N, 2*Bx - ((1 << N) - 1), 2*By - ((1 << N) - 1))
         return self.cgr_coords
     
     def reset_coords(self,):
         self.cgr_coords = CGRCoords(0,0,0)
 
     def decode(self, N:int, x:int, y:int)->str: 
-        "From CGR to DNA sequence"
+        "From CGR to DNA sequence, reading the bits of Bx and By (see encode)"
+        N, x, y = int(N), int(x), int(y) # NumPy integers (e.g. from encode_many) have no bit_length/to_bytes
+        if not self.use_bitplanes:
+            return self.decode_reference(N, x, y)
+        bitplanes = []
+        for coord in (x,y):
+            B, odd = divmod(coord + (1 << N) - 1, 2)
+            if odd or B < 0 or B.bit_length() > N:
+                raise ValueError(f"({x},{y}) are not iCGR coordinates of a sequence of length {N}")
+            packed = np.frombuffer(B.to_bytes(-(-N // 8), "little"), dtype=np.uint8)
+            bitplanes.append(np.unpackbits(packed, count=N, bitorder="little"))
+        self.cgr_coords = CGRCoords(N,x,y)
+        return self.bits2nuc[bitplanes[0], bitplanes[1]].tobytes().decode()
+
+    def encode_many(self, kmers):
+        """iCGR (x,y) coordinates of many k-mers of the same length N <= 32 at once, as int64 arrays (see encode).
+        kmers is a NumPy S-dtype array (or a list of str) or a (n,N) uint8 array"""
+        if not self.use_bitplanes:
+            raise ValueError("encode_many requires the coordinates of the nucleotides to be (+-1,+-1)")
+        kmers = kmers2array(kmers)
+        bx, by = self.nuc2bit[:,0][kmers], self.nuc2bit[:,1][kmers]
+        if (bx == 2).any():
+            raise ValueError(f"k-mers must contain only {list(self.nucleotide_coords)}")
+        N = kmers.shape[1]
+        if N > 32:
+            raise ValueError("encode_many supports k-mers up to length 32")
+        Bx, By = pack_digits(bx, 1).astype(np.int64), pack_digits(by, 1).astype(np.int64)
+        return 2*Bx - ((1 << N) - 1), 2*By - ((1 << N) - 1)
+
+    def decode_many(self, x: np.ndarray, y: np.ndarray, N: int) -> np.ndarray:
+        "k-mers (S-dtype array) from their iCGR (x,y) coordinates (see encode_many), all of length N"
+        if not self.use_bitplanes:
+            raise ValueError("decode_many requires the coordinates of the nucleotides to be (+-1,+-1)")
+        Bx, By = ((np.asarray(coord, dtype=np.int64) + ((1 << N) - 1)) >> 1 for coord in (x,y))
+        return self.bits2nuc[unpack_digits(Bx, 1, N), unpack_digits(By, 1, N)].view(f"S{N}").ravel()
+
+    def encode_reference(self, sequence: str):
+        "From DNA sequence to CGR, one nucleotide at a time. Kept as reference"
+        # reset starting position to (0,0,0)
+        self.reset_coords()
+        for nucleotide in sequence:
+            self.forward(nucleotide)
+        return self.cgr_coords
+
+    def decode_reference(self, N:int, x:int, y:int)->str: 
+        "From CGR to DNA sequence, one nucleotide at a time. Kept as reference"
         self.cgr_coords = CGRCoords(N,x,y)
         
         # decoded sequence
@@ -91,4 +152,4 @@ class iCGR:
         while self.cgr_coords.N>0: 
             nucleotide = self.backward()
             sequence.append(nucleotide)
-        return "".join(sequence[::-1])      
\ No newline at end of file
+        return "".join(sequence[::-1])
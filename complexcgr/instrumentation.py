@@ -0,0 +1,168 @@
+"""
+Instrumentation of the stages of the pipelines: wall time, bases, reads and bytes processed in each stage.
+Stages are "io" (read and parse files), "kmers" (k-mer extraction), "counting", "pixels" (k-mers to FCGR) and "render".
+
+It is off by default (the current instrument does nothing), to turn it on use an instrument as a context manager
+>>> with Recorder() as recorder:
+...     fcgr(seq)
+>>> recorder.stats # {"kmers": {"seconds": ..., "calls": ..., "bases": ..., "reads": ..., "n_bytes": ...}, ...}
+
+>>> with Callback(print): # or any function receiving a StageEvent
+...     fcgr(seq)
+
+>>> with ProgressBar(): # tqdm progress bar over the bytes read
+...     FCGRSamples(k=6)("reads.fastq")
+"""
+from collections import namedtuple
+from contextvars import ContextVar
+from time import perf_counter
+
+STAGES = ("io", "kmers", "counting", "pixels", "render")
+
+StageEvent = namedtuple("StageEvent", ["stage", "seconds", "bases", "reads", "n_bytes"])
+
+class Instrument:
+    "Receives the stages of the pipelines. This one does nothing, subclasses set enabled = True"
+    enabled = False
+
+    def record(self, stage: str, seconds: float, bases: int = 0, reads: int = 0, n_bytes: int = 0):
+        "A stage was completed"
+
+    def start(self, desc: str, total: int = None):
+        "A task of total bytes (None if unknown) starts"
+
+    def finish(self,):
+        "The current task is done"
+
+    def __enter__(self,):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _current.reset(self._token)
+
+_current = ContextVar("complexcgr_instrument", default=Instrument())
+
+def get_instrument() -> Instrument:
+    "Instrument used in the current context"
+    return _current.get()
+
+class _Stage:
+    "Time a stage and record it with its counters, which can be set inside the with block"
+    __slots__ = ("instrument", "name", "bases", "reads", "n_bytes", "_start")
+
+    def __init__(self, instrument, name, bases, reads, n_bytes):
+        self.instrument, self.name = instrument, name
+        self.bases, self.reads, self.n_bytes = bases, reads, n_bytes
+
+    def __enter__(self,):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrument.record(self.name, perf_counter() - self._start, self.bases, self.reads, self.n_bytes)
+
+class _NullStage:
+    "Stage when the instrumentation is off: nothing is timed, counters set on it are ignored"
+    __slots__ = ("bases", "reads", "n_bytes")
+
+    def __enter__(self,):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+def stage(name: str, bases: int = 0, reads: int = 0, n_bytes: int = 0):
+    "Context manager timing a stage in the current instrument (a no-op if it is off)"
+    instrument = _current.get()
+    if instrument.enabled is False:
+        return _NULL_STAGE
+    return _Stage(instrument, name, bases, reads, n_bytes)
+
+class progress:
+    "Context manager for a task of total bytes, e.g. a file, used by progress bars"
+    __slots__ = ("desc", "total", "instrument")
+
+    def __init__(self, desc: str, total: int = None):
+        self.desc, self.total = desc, total
+
+    def __enter__(self,):
+        self.instrument = _current.get()
+        self.instrument.start(self.desc, self.total)
+        return self
+
+    def __exit__(self, *exc):
+        self.instrument.finish()
+
+def timed_iter(iterable, name: str = "io"):
+    """Iterate recording the time to get each item in a stage. Blocks of bytes add their size to the stage,
+    and batches of reads (fastx.ReadBatch) their bytes and reads"""
+    iterator = iter(iterable)
+    while True:
+        with stage(name) as current:
+            item = next(iterator, None)
+            if isinstance(item, (bytes, bytearray)):
+                current.n_bytes = len(item)
+            elif item is not None:
+                current.n_bytes = getattr(item, "n_bytes", 0)
+                current.reads = getattr(item, "n_reads", 0)
+        if item is None:
+            return
+        yield item
+
+def record_stats(stats: dict):
+    "Record the stats of a Recorder (e.g. from another process) in the current instrument"
+    instrument = _current.get()
+    for name, counters in stats.items():
+        instrument.record(name, counters["seconds"], counters["bases"], counters["reads"], counters["n_bytes"])
+
+# # --------------- consumers ---------------- # #
+class Recorder(Instrument):
+    "Accumulate time, calls, bases, reads and bytes of each stage in stats"
+    enabled = True
+
+    def __init__(self,):
+        self.stats = {}
+
+    def record(self, stage, seconds, bases=0, reads=0, n_bytes=0):
+        stats = self.stats.get(stage)
+        if stats is None:
+            stats = self.stats[stage] = dict(seconds=0.0, calls=0, bases=0, reads=0, n_bytes=0)
+        stats["seconds"] += seconds
+        stats["calls"] += 1
+        stats["bases"] += bases
+        stats["reads"] += reads
+        stats["n_bytes"] += n_bytes
+
+class Callback(Instrument):
+    "Call a function with a StageEvent for each stage completed"
+    enabled = True
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def record(self, stage, seconds, bases=0, reads=0, n_bytes=0):
+        self.callback(StageEvent(stage, seconds, bases, reads, n_bytes))
+
+class ProgressBar(Instrument):
+    "tqdm progress bar of each task, updated with the bytes read"
+    enabled = True
+
+    def __init__(self, **tqdm_kwargs):
+        self.tqdm_kwargs = tqdm_kwargs
+        self.pbar = None
+
+    def start(self, desc, total=None):
+        from tqdm import tqdm
+        self.pbar = tqdm(total=total, unit="B", unit_scale=True, desc=desc, **self.tqdm_kwargs)
+
+    def record(self, stage, seconds, bases=0, reads=0, n_bytes=0):
+        if self.pbar is not None and n_bytes:
+            self.pbar.update(n_bytes)
+
+    def finish(self,):
+        if self.pbar is not None:
+            self.pbar.close()
+            self.pbar = None
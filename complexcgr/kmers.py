@@ -0,0 +1,180 @@
+"Vectorized k-mer counting over 2-bit encoded sequences"
+import numpy as np
+from functools import lru_cache
+from .instrumentation import stage
+
+# 2-bit code of each nucleotide, following the order used to list k-mers in FCGR (A,C,G,T)
+# any other symbol (N, IUPAC codes, newlines, ...) is marked as INVALID
+INVALID = 4
+NUC2BITS = np.full(256, INVALID, dtype=np.uint8)
+for bits, nucleotide in enumerate("ACGT"):
+    NUC2BITS[ord(nucleotide)] = bits
+    NUC2BITS[ord(nucleotide.lower())] = bits
+
+# number of k-mers processed at once, bounds the memory used for the rolling codes
+BLOCK_SIZE = 2**22
+
+def seq2bits(sequence) -> np.ndarray:
+    "Map a sequence (str, bytes or uint8 array) to 2-bit codes, non-ACGT symbols are INVALID"
+    if isinstance(sequence, str):
+        sequence = sequence.encode("ascii", errors="replace")
+    if isinstance(sequence, (bytes, bytearray, memoryview)):
+        sequence = np.frombuffer(sequence, dtype=np.uint8)
+    return NUC2BITS[np.asarray(sequence, dtype=np.uint8)]
+
+def kmers2array(kmers) -> np.ndarray:
+    """(n,k) uint8 array with the symbols of n k-mers, from a NumPy S-dtype array, a list of str/bytes
+    or an (n,k) uint8 array. All the k-mers must have the same length"""
+    kmers = np.asarray(kmers)
+    if kmers.dtype.kind == "U":
+        kmers = kmers.astype("S")
+    if kmers.dtype.kind == "S":
+        k = kmers.dtype.itemsize
+        kmers = np.ascontiguousarray(kmers).view(np.uint8).reshape(-1, k)
+        if (kmers == 0).any():
+            raise ValueError("all the k-mers must have the same length")
+    if kmers.dtype != np.uint8 or kmers.ndim != 2:
+        raise ValueError("k-mers must be an S-dtype array or a (n,k) uint8 array")
+    return kmers
+
+def pack_digits(digits: np.ndarray, width: int) -> np.ndarray:
+    "uint64 with the digits (of width bits) of each row of a (n,N) array, the first digit the least significant"
+    packed = np.zeros(len(digits), dtype=np.uint64)
+    for i in range(digits.shape[1]):
+        packed |= digits[:,i].astype(np.uint64) << np.uint64(width*i)
+    return packed
+
+def unpack_digits(packed: np.ndarray, width: int, N: int) -> np.ndarray:
+    "(n,N) uint8 array with the first N digits (of width bits) of each uint64, inverse of pack_digits"
+    packed = np.asarray(packed, dtype=np.uint64)
+    digits = np.empty((len(packed), N), dtype=np.uint8)
+    mask = np.uint64(2**width - 1)
+    for i in range(N):
+        digits[:,i] = (packed >> np.uint64(width*i)) & mask
+    return digits
+
+def kmer_codes(bits: np.ndarray, k: int):
+    """Rolling integer code of each k-mer in a 2-bit encoded sequence.
+    Returns the codes and a mask with the k-mers without INVALID symbols.
+    The code of a k-mer is its index in the lexicographic list of all k-mers"""
+    n_kmers = len(bits) - k + 1
+    if n_kmers <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+
+    # a k-mer is valid if there are no invalid symbols in its window
+    n_invalid = np.concatenate(([0], np.cumsum(bits == INVALID, dtype=np.int32)))
+    valid = (n_invalid[k:] - n_invalid[:-k]) == 0
+
+    # shift in one nucleotide at a time for all the k-mers
+    bits = bits & 3
+    codes = np.zeros(n_kmers, dtype=np.int64)
+    for j in range(k):
+        codes <<= 2
+        codes |= bits[j:j+n_kmers]
+    return codes, valid
+
+def sliding_min(values: np.ndarray, k: int) -> np.ndarray:
+    """Minimum of each window of length k, in linear time (van Herk/Gil-Werman).
+    Values are split in blocks of length k: a window covers the end of a block and the start
+    of the next one, so its minimum comes from the suffix and prefix minima of both blocks"""
+    n_windows = len(values) - k + 1
+    if n_windows <= 0:
+        return np.zeros(0, dtype=values.dtype)
+    n_blocks = -(-len(values) // k)
+    padded = np.full(n_blocks*k, values.max(), dtype=values.dtype)
+    padded[:len(values)] = values
+    blocks = padded.reshape(n_blocks, k)
+    prefix_min = np.minimum.accumulate(blocks, axis=1).ravel()
+    suffix_min = np.minimum.accumulate(blocks[:,::-1], axis=1)[:,::-1].ravel()
+    return np.minimum(suffix_min[:n_windows], prefix_min[k-1:k-1+n_windows])
+
+def accumulate(codes: np.ndarray, counts: np.ndarray):
+    "Add the occurrences of each code to counts (in place)"
+    if len(codes) < len(counts) // 8:
+        # few codes: avoid allocating a full array of 4**k cells
+        np.add.at(counts, codes, 1)
+    else:
+        counts += np.bincount(codes, minlength=len(counts)).astype(counts.dtype, copy=False)
+    return counts
+
+def block_bases(start: int, n_kmers: int, k: int, block_size: int) -> int:
+    """Bases of a sequence in the block of (at most block_size) k-mers from start. Blocks overlap
+    by k-1 bases, counted only in the first block, so the blocks add up to the length of the sequence"""
+    return min(block_size, n_kmers - start) + (k-1 if start == 0 else 0)
+
+def count_kmers(sequence, k: int, counts: np.ndarray = None, sample_fraction: float = None) -> np.ndarray:
+    """Count the k-mers of a sequence in a flat array of 4**k cells indexed by k-mer code.
+    k-mers with non-ACGT symbols are not counted.
+    With sample_fraction, only the k-mers kept by frac_sample are counted (counts are not rescaled)"""
+    return count_bits(seq2bits(sequence), k, counts, sample_fraction)
+
+def count_bits(bits: np.ndarray, k: int, counts: np.ndarray = None, sample_fraction: float = None) -> np.ndarray:
+    "Same as count_kmers, for a sequence already encoded with seq2bits"
+    if counts is None:
+        counts = np.zeros(4**k, dtype=np.int64)
+    sampled = None if sample_fraction is None else sample_table(k, sample_fraction)
+    n_kmers = len(bits) - k + 1
+    for start in range(0, max(n_kmers, 0), BLOCK_SIZE):
+        block = bits[start:start+BLOCK_SIZE+k-1]
+        with stage("kmers", bases=block_bases(start, n_kmers, k, BLOCK_SIZE)):
+            codes, valid = kmer_codes(block, k)
+            if sampled is not None:
+                valid &= sampled[codes]
+        with stage("counting"):
+            accumulate(codes[valid], counts)
+    return counts
+
+# # --------------- FracMinHash sampling ---------------- # #
+def hash_codes(codes: np.ndarray, seed: int = 0) -> np.ndarray:
+    "64-bit hash (splitmix64) of k-mer codes, as uint64. Each seed gives an independent hash"
+    x = np.asarray(codes).astype(np.uint64)
+    with np.errstate(over="ignore"):
+        x += np.uint64((seed+1) * 0x9E3779B97F4A7C15 % 2**64)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def frac_sample(codes: np.ndarray, fraction: float, seed: int = 0) -> np.ndarray:
+    """FracMinHash: mask of the k-mer codes whose hash is below fraction * 2**64.
+    A k-mer is kept (or not) in every sequence, so samples counted with the same fraction and seed keep 
+    the same k-mers and can be compared. Any stream of codes can be sampled with it, for any k <= 32"""
+    if not 0 < fraction <= 1:
+        raise ValueError("the fraction of k-mers sampled must be in (0,1]")
+    if fraction == 1:
+        return np.ones(np.shape(codes), dtype=bool)
+    return hash_codes(codes, seed) < np.uint64(int(fraction * 2**64))
+
+@lru_cache(maxsize=8)
+def sample_table(k: int, fraction: float, seed: int = 0) -> np.ndarray:
+    "frac_sample of all the k-mers, indexed by their 2-bit code (a lookup is cheaper than hashing each k-mer)"
+    table = frac_sample(np.arange(4**k, dtype=np.int64), fraction, seed)
+    table.setflags(write=False)
+    return table
+
+# # --------------- reverse complement and canonical k-mers ---------------- # #
+def reverse_codes(codes: np.ndarray, k: int) -> np.ndarray:
+    "Reverse the order of the nucleotides of 2-bit k-mer codes (k <= 32)"
+    x = np.asarray(codes).astype(np.uint64)
+    # swap 2-bit groups, then nibbles, bytes, ... up to the two halves of a 64-bit word
+    for shift, mask in ((2, 0x3333333333333333), (4, 0x0F0F0F0F0F0F0F0F), (8, 0x00FF00FF00FF00FF),
+                        (16, 0x0000FFFF0000FFFF), (32, 0x00000000FFFFFFFF)):
+        shift, mask = np.uint64(shift), np.uint64(mask)
+        x = ((x >> shift) & mask) | ((x & mask) << shift)
+    # the k-mer is now in the highest 2k bits
+    return (x >> np.uint64(64-2*k)).astype(np.int64)
+
+def reverse_complement_codes(codes: np.ndarray, k: int) -> np.ndarray:
+    "Reverse complement of 2-bit k-mer codes (k <= 32). The complement of a nucleotide is 3 - its code"
+    return reverse_codes(~np.asarray(codes).astype(np.uint64), k)
+
+def canonical_codes(codes: np.ndarray, k: int) -> np.ndarray:
+    "Canonical k-mer (the smallest between a k-mer and its reverse complement) of 2-bit k-mer codes"
+    return np.minimum(codes, reverse_complement_codes(codes, k))
+
+def canonical_index(k: int):
+    """Index of each k-mer (by 2-bit code) in the compact list of canonical k-mers (sorted),
+    and the number of canonical k-mers"""
+    codes = np.arange(4**k, dtype=np.int64)
+    canonical = canonical_codes(codes, k)
+    rank = np.cumsum(codes == canonical) - 1
+    return rank[canonical], int(rank[-1]) + 1
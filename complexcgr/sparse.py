@@ -0,0 +1,52 @@
+"Sparse representation of FCGRs"
+import numpy as np
+
+class SparseFCGR:
+    """FCGR stored as the flat index (row*2**k + col) of its non-empty pixels and their counts (COO format).
+    For high k, a single assembly fills only a small fraction of the 4**k pixels.
+    - indices: sorted flat indices of the non-empty pixels
+    - counts: count of each non-empty pixel
+    - shape: shape of the dense FCGR (2**k, 2**k), or (n,) for the compact layout of canonical k-mers
+    """
+    def __init__(self, indices: np.ndarray, counts: np.ndarray, shape: tuple):
+        self.indices = indices
+        self.counts = counts
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_dense(cls, fcgr: np.ndarray):
+        "Sparse FCGR from a dense one"
+        flat = np.asarray(fcgr).ravel()
+        indices = np.flatnonzero(flat)
+        return cls(indices, flat[indices], fcgr.shape)
+
+    def todense(self, dtype=None):
+        "Dense FCGR"
+        fcgr = np.zeros(int(np.prod(self.shape)), dtype=dtype or self.counts.dtype)
+        fcgr[self.indices] = self.counts
+        return fcgr.reshape(self.shape)
+
+    def tocoo(self,):
+        "Row, column and count of the non-empty pixels"
+        if len(self.shape) == 1:
+            return self.indices, np.zeros_like(self.indices), self.counts
+        rows, cols = np.divmod(self.indices, self.shape[1])
+        return rows, cols, self.counts
+
+    @property
+    def nnz(self,):
+        "number of non-empty pixels"
+        return len(self.indices)
+
+    @property
+    def nbytes(self,):
+        return self.indices.nbytes + self.counts.nbytes
+
+    def __eq__(self, other):
+        if not isinstance(other, SparseFCGR):
+            return NotImplemented
+        return (self.shape == other.shape and np.array_equal(self.indices, other.indices)
+                and np.array_equal(self.counts, other.counts))
+
+    def __repr__(self,):
+        return f"SparseFCGR(shape={self.shape}, nnz={self.nnz}, dtype={self.counts.dtype})"
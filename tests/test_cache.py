@@ -0,0 +1,60 @@
+import os
+import time
+import random
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from complexcgr import FCGR, FCGRCache
+from complexcgr.fcgr_samples import FCGRSamples
+from tests.test_fcgr_samples import random_reads, write_fastq
+
+def test_cache(tmp_path):
+    "FCGRs (and pixel maps) are computed once, and read memory-mapped from the cache"
+    cache = FCGRCache(tmp_path)
+    seq = "".join(random.choice("ACGTN") for _ in range(5_000))
+    expected = FCGR(k=5)(seq)
+
+    fcgr = FCGR(k=5, cache=cache)
+    assert (fcgr(seq) == expected).all()
+    n_files = len(cache.entries()) # pixel map and FCGR
+    cached = FCGR(k=5, cache=cache)(seq)
+    assert isinstance(cached, np.memmap) and (cached == expected).all()
+    assert len(cache.entries()) == n_files == 2
+
+    # different options or input, different entries
+    FCGR(k=5, cache=cache, use_canonical_kmers=True)(seq)
+    FCGR(k=5, cache=cache)(seq[1:])
+    assert len(cache.entries()) > n_files
+
+    # the input is identified by its content
+    reads, quals = random_reads(50, 100)
+    write_fastq(tmp_path.joinpath("reads.fastq"), reads, quals)
+    fcgr = FCGRSamples(k=4, cache=cache)
+    assert (fcgr(tmp_path.joinpath("reads.fastq")) == FCGRSamples(k=4)(tmp_path.joinpath("reads.fastq"))).all()
+    write_fastq(tmp_path.joinpath("reads.fastq"), reads[:10], quals[:10])
+    assert (fcgr(tmp_path.joinpath("reads.fastq")) == FCGRSamples(k=4)(tmp_path.joinpath("reads.fastq"))).all()
+
+def test_cache_eviction(tmp_path):
+    "least recently used arrays are removed first"
+    cache = FCGRCache(tmp_path, max_bytes=3*(8*100 + 128))
+    for j in range(3):
+        cache.put(f"a{j}", np.full(100, j, dtype=np.float64))
+        time.sleep(0.01)
+    cache.get("a0") # a1 is now the least recently used
+    time.sleep(0.01)
+    cache.put("a3", np.full(100, 3, dtype=np.float64))
+    assert cache.get("a1") is None
+    assert all(cache.get(key) is not None for key in ("a0", "a2", "a3"))
+    assert cache.size() <= cache.max_bytes
+
+def _fcgr_with_cache(args):
+    path, seq = args
+    return np.array(FCGR(k=4, cache=FCGRCache(path, max_bytes=20_000))(seq))
+
+def test_cache_processes(tmp_path):
+    "several processes reading, writing and evicting the same cache"
+    seqs = ["".join(random.choice("ACGT") for _ in range(1_000)) for _ in range(10)] * 3
+    with ProcessPoolExecutor(2) as pool:
+        fcgrs = list(pool.map(_fcgr_with_cache, [(tmp_path, seq) for seq in seqs]))
+    fcgr = FCGR(k=4)
+    assert all((result == fcgr(seq)).all() for result, seq in zip(fcgrs, seqs))
+    assert not [name for name in os.listdir(tmp_path) if name.startswith(".tmp-")]
@@ -31,4 +31,46 @@ def test_cgr_decode():
     assert cgr.decode(N=1,x=0.5,y=0.5) == "A"
     assert cgr.decode(N=1,x=-0.5,y=0.5) == "C"
     assert cgr.decode(N=1,x=-0.5,y=-0.5) == "G"
-    assert cgr.decode(N=1,x=0.5,y=-0.5) == "T"
\ No newline at end of file
+    assert cgr.decode(N=1,x=0.5,y=-0.5) == "T"
+
+def test_trajectory():
+    "trajectory matches the nucleotide by nucleotide encoding, skipping or resetting after N's"
+    import random
+    import numpy as np
+    cgr = CGR()
+    seq = "".join(random.choice("ACGT") for _ in range(500))
+    points = cgr.trajectory(seq)
+    expected = []
+    for nucleotide in seq:
+        cgr.forward(nucleotide)
+        expected.append((cgr.cgr_coords.x, cgr.cgr_coords.y))
+    assert points.shape == (500, 2)
+    assert np.allclose(points, expected, rtol=0, atol=1e-15)
+
+    assert np.allclose(cgr.trajectory("ACNNGT"), cgr.trajectory("ACGT"), rtol=0, atol=1e-15)
+    assert np.allclose(cgr.trajectory(seq[:200] + "N" + seq[200:], invalid="reset"),
+                       np.concatenate([cgr.trajectory(seq[:200]), cgr.trajectory(seq[200:])]), rtol=0, atol=1e-15)
+
+def test_density():
+    "density at resolution 2**k is the FCGR of k-mers"
+    import random
+    from complexcgr import FCGR
+    k = 5
+    seq = "".join(random.choice("ACGT") for _ in range(5_000))
+    cgr = CGR()
+    assert (cgr.density(cgr.trajectory(seq)[k-1:], 2**k) == FCGR(k)(seq)).all()
+    assert cgr.density(seq, 7).sum() == len(seq)
+
+
+def test_encode_decode_many():
+    "bulk codec gives the cell of the CGR point of each k-mer in a 2**N x 2**N grid"
+    import random
+    import numpy as np
+    cgr = CGR()
+    kmers = ["".join(random.choice("ACGT") for _ in range(20)) for _ in range(100)]
+    cols, rows = cgr.encode_many(kmers)
+    for kmer, col, row in zip(kmers, cols, rows):
+        point = cgr.encode(kmer)
+        assert np.isclose((2*int(col)+1) / 2**20 - 1, point.x)
+        assert np.isclose((2*int(row)+1) / 2**20 - 1, point.y)
+    assert cgr.decode_many(cols, rows, 20).astype(str).tolist() == kmers
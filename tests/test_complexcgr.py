@@ -60,4 +60,40 @@ def test_encode_decode_compatibility():
     seq = "ACGT"
     encode = ccgr.encode(seq)
     decode = ccgr.decode(encode.k, encode.N)
-    assert seq == decode 
\ No newline at end of file
+    assert seq == decode 
+
+def test_encode_decode_long_sequence():
+    "packed codec matches the nucleotide by nucleotide one, also for a custom nucleotide order"
+    import random
+    for nucleotide_order in (["A","C","G","T"], ["T","G","A","C"]):
+        ccgr = ComplexCGR(nucleotide_order)
+        for length in (0, 1, 5, 1_001):
+            seq = "".join(random.choice("ACGT") for _ in range(length))
+            encode = ccgr.encode(seq)
+            assert encode == ccgr.encode_reference(seq)
+            assert ccgr.decode(encode.k, encode.N) == seq
+            assert ccgr.decode_reference(encode.k, encode.N) == seq
+
+    seq = "".join(random.choice("ACGT") for _ in range(1_000_000))
+    encode = ccgr.encode(seq)
+    assert ccgr.decode(encode.k, encode.N) == seq
+
+
+def test_encode_decode_many():
+    "bulk codec matches encode for each k-mer"
+    import random
+    import numpy as np
+    ccgr = ComplexCGR(["T","G","A","C"])
+    kmers = ["".join(random.choice("ACGT") for _ in range(31)) for _ in range(100)]
+    ks = ccgr.encode_many(np.array(kmers, dtype="S31"))
+    assert ks.dtype == np.uint64
+    assert [int(k) for k in ks] == [ccgr.encode(kmer).k for kmer in kmers]
+    assert ccgr.decode_many(ks, 31).astype(str).tolist() == kmers
+
+def test_decode_numpy_integers():
+    "decode accepts NumPy integers, e.g. the output of encode_many"
+    import numpy as np
+    ccgr = ComplexCGR()
+    ks = ccgr.encode_many(["ACGTTG", "GGCATA"])
+    assert [ccgr.decode(k, np.int64(6)) for k in ks] == ["ACGTTG", "GGCATA"]
+    assert ccgr.decode(np.int64(ks[0]), 6) == "ACGTTG"
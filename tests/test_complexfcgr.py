@@ -0,0 +1,43 @@
+import random
+import numpy as np
+from collections import Counter
+from complexcgr import ComplexFCGR
+
+def test_count_kmers():
+    "vectorized counts, indexed by ComplexCGR k"
+    k = 4
+    seq = "".join(random.choice("ACGTN") for _ in range(5_000))
+    cfcgr = ComplexFCGR(k)
+    cfcgr.count_kmers(seq)
+    expected = Counter(seq[j:j+k] for j in range(len(seq)-k+1) if "N" not in seq[j:j+k])
+    assert cfcgr.freq_kmer == dict(expected)
+    for kmer, count in expected.items():
+        assert cfcgr.counts[cfcgr.encode(kmer).k] == count
+
+def test_render():
+    "raster images, one at a time or in batch"
+    k = 5
+    cfcgr = ComplexFCGR(k)
+    sequences = ["".join(random.choice("ACG") for _ in range(2_000)) for _ in range(3)]
+    images = cfcgr.render_sequences(sequences, size=128)
+    assert images.shape == (3, 128, 128) and images.dtype == np.uint8
+    for seq, img in zip(sequences, images):
+        cfcgr.count_kmers(seq)
+        cfcgr.kmer_probabilities(seq)
+        assert (cfcgr.render(size=128) == img).all()
+    assert cfcgr.render(size=64, bits=16).dtype == np.uint16
+
+    # a single k-mer: only its bar (the first quarter of the circle for k=1) is drawn, in black
+    img = ComplexFCGR(1).render(np.array([1.,0,0,0]), size=64, w=0)
+    assert img[:32,32:].min() == 0
+    assert img[32:].min() == 255 and img[:,:32].min() == 255
+
+def test_save_raster(tmp_path):
+    "raster images saved with the size and bits given to save"
+    from PIL import Image
+    cfcgr = ComplexFCGR(4)
+    fig = cfcgr("".join(random.choice("ACGT") for _ in range(1_000)))
+    cfcgr.save(fig, tmp_path.joinpath("img.png"), backend="raster", size=96, bits=16)
+    img = np.array(Image.open(tmp_path.joinpath("img.png")))
+    assert img.shape == (96, 96)
+    assert (img == cfcgr.render(size=96, bits=16)).all()
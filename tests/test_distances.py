@@ -0,0 +1,61 @@
+import numpy as np
+from complexcgr import FCGRDataset, FCGRIndex
+from complexcgr.distances import pairwise_distances, frequencies, pool
+
+def jensenshannon(p, q):
+    m = (p + q) / 2
+    kl = lambda a: np.where(a > 0, a * np.log2(np.where(a > 0, a, 1) / np.where(m > 0, m, 1)), 0).sum()
+    return np.sqrt((kl(p) + kl(q)) / 2)
+
+def test_pairwise_distances():
+    "blocked distances are the same as computed pair by pair"
+    rng = np.random.default_rng(0)
+    references = rng.poisson(2, size=(30, 16, 16))
+    queries = rng.poisson(2, size=(4, 16, 16))
+    queries[1, :12] = 0 # sparse query
+    queries[2] = references[5]
+    p, r = frequencies(queries, "float64"), frequencies(references, "float64")
+    expected = {
+        "euclidean": np.sqrt(((p[:,None] - r[None])**2).sum(axis=-1)),
+        "cosine": 1 - (p @ r.T) / np.outer(np.linalg.norm(p, axis=1), np.linalg.norm(r, axis=1)),
+        "jensenshannon": np.array([[jensenshannon(a, b) for b in r] for a in p]),
+    }
+    for metric, distances in expected.items():
+        assert np.allclose(pairwise_distances(queries, references, metric, dtype="float64"), distances, atol=1e-6)
+        assert np.allclose(pairwise_distances(queries, references, metric), distances, atol=1e-4)
+    assert np.isclose(pairwise_distances(queries[2:3], references[5:6], "jensenshannon")[0,0], 0, atol=1e-4)
+
+def test_pool():
+    "pooling a FCGR for k to k-1 sums the 4 k-mers with the same suffix"
+    fcgrs = np.arange(2*64).reshape(2, 8, 8)
+    pooled = pool(fcgrs, 2)
+    assert pooled.shape == (2, 4, 4)
+    assert pooled[0,0,0] == 0 + 1 + 8 + 9
+    assert pooled.sum() == fcgrs.sum()
+
+def test_fcgr_index(tmp_path, monkeypatch):
+    "nearest neighbours of FCGRs in a dataset, read in small blocks, with and without prefilter"
+    from complexcgr import distances
+    monkeypatch.setattr(distances, "BLOCK_BYTES", 4*256*7)
+    rng = np.random.default_rng(1)
+    centers = rng.gamma(1, 1, size=(5, 16, 16)) * 50
+    labels = rng.integers(0, 5, size=100)
+    dataset = FCGRDataset.create(tmp_path.joinpath("references.fcgr"), k=4, dtype="uint16")
+    dataset.extend(rng.poisson(centers[labels]), [f"ref{j}" for j in range(100)])
+    queries = rng.poisson(centers)
+
+    for metric in ("euclidean", "cosine", "jensenshannon"):
+        index = FCGRIndex(dataset, metric=metric)
+        indices, dists = index.nearest(queries, n_neighbors=5)
+        expected = np.argsort(index.distances(queries), axis=1, kind="stable")[:,:5]
+        assert (indices == expected).all()
+        assert (np.diff(dists, axis=1) >= 0).all()
+
+        # pooled to k=2, the closest references are still from the same center
+        index = FCGRIndex(dataset, metric=metric, prefilter_k=2)
+        indices_prefilter, _ = index.nearest(queries, n_neighbors=5, n_candidates=20)
+        assert (labels[indices_prefilter] == np.arange(5)[:,None]).all()
+        assert (index.nearest(queries, n_neighbors=5, n_candidates=100)[0] == indices).all()
+
+    # a single FCGR is a query
+    assert index.nearest(queries[3], n_neighbors=2)[0].shape == (1, 2)
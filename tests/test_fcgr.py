@@ -1,5 +1,7 @@
 import random
-from complexcgr import FCGR 
+import pytest
+import numpy as np
+from complexcgr import FCGR, SparseFCGR
 
 def test_fcgr():
     "frecuency matrix CGR"
@@ -18,13 +20,130 @@ def test_savefig():
     chaos = fcgr(seq) # an array with the probabilities of each k-mer
     fcgr.save_img(chaos, path="img/ACG.jpg")
 
-def test_savefig_16bits():
+def test_savefig_16bits(tmp_path):
+    from PIL import Image
     fcgr = FCGR(k=8, bits=16)
     # Generate a random sequence without T's
     seq = "".join(random.choice("ACG") for _ in range(30_000))
     chaos = fcgr(seq) # an array with the probabilities of each k-mer
-    fcgr.save_img(chaos, path="img/ACG_16bits.jpg")
+    fcgr.save_img(chaos, path=tmp_path.joinpath("ACG_16bits.png"))
 
+    img = Image.open(tmp_path.joinpath("ACG_16bits.png"))
+    assert img.mode == "I;16"
+    pixels = np.array(img)
+    assert pixels.min() == 0 and pixels.max() == 2**16-1
+    # the darkest pixel is the most frequent k-mer
+    assert (pixels == 0).sum() == (chaos == chaos.max()).sum()
 
+def test_fcgr_reference():
+    "vectorized counting gives the same FCGR as the dict-based implementation"
+    seq = "".join(random.choice("ACGTN") for _ in range(5_000))
+    for k in range(1,6):
+        fcgr = FCGR(k=k)
+        assert (fcgr(seq) == fcgr.fcgr_reference(seq)).all()
 
+def test_pixel_index():
+    "closed-form pixel of each k-mer matches the pixel given by its CGR encoding"
+    for k in range(1,6):
+        fcgr = FCGR(k=k)
+        assert fcgr.kmer2pixel == fcgr.kmer2pixel_position()
 
+def test_batch(tmp_path):
+    "batch of FCGRs in the same order as the input, with one or several processes"
+    fcgr = FCGR(k=4)
+    seqs = ["".join(random.choice("ACGTN") for _ in range(random.randint(1,2_000))) for _ in range(10)]
+    expected = np.stack([fcgr(seq) for seq in seqs])
+
+    assert (fcgr.batch(seqs) == expected).all()
+    assert (fcgr.batch(seqs, n_jobs=2, chunksize=3) == expected).all()
+    
+    batch = fcgr.batch(iter(seqs), n_jobs=2, dtype=np.uint32, path=tmp_path.joinpath("batch.npy"), n=len(seqs))
+    assert batch.dtype == np.uint32
+    assert (np.load(tmp_path.joinpath("batch.npy")) == expected).all()
+
+    # the number of sequences is needed up front for iterators, and must match
+    with pytest.raises(ValueError):
+        fcgr.batch(iter(seqs))
+    with pytest.raises(ValueError):
+        fcgr.batch(iter(seqs), n_jobs=2, chunksize=3, n=5)
+    with pytest.raises(ValueError):
+        fcgr.batch(iter(seqs), n=11)
+
+    # integer dtypes saturate, as in __call__
+    high = ["A"*70_000, "C"*10, "G"*300]
+    for dtype in ("uint8", "uint16"):
+        expected = np.minimum(np.stack([FCGR(k=1)(seq) for seq in high]), np.iinfo(dtype).max)
+        if dtype == "uint16":
+            assert (expected == np.stack([FCGR(k=1, dtype=dtype)(seq) for seq in high])).all()
+        for n_jobs in (1, 2):
+            batch = FCGR(k=1).batch(high, n_jobs=n_jobs, dtype=dtype, chunksize=1)
+            assert batch.dtype == dtype and (batch == expected).all()
+
+    # dtype and shape of the FCGR
+    compact = FCGR(k=4, use_canonical_kmers=True, canonical_layout="compact", dtype="uint16")
+    batch = compact.batch(seqs, n_jobs=2, chunksize=3)
+    assert batch.dtype == np.uint16 and batch.shape == (10, compact.n_canonical)
+    assert (batch == np.stack([compact(seq) for seq in seqs])).all()
+
+def test_canonical_kmers():
+    "each k-mer is counted in the pixel of its canonical k-mer, in the dense and compact layouts"
+    seq = "".join(random.choice("ACGTN") for _ in range(5_000))
+    for k in range(1,6):
+        fcgr = FCGR(k=k, use_canonical_kmers=True)
+        assert fcgr.kmer2pixel == fcgr._kmer2pixel_canonical_kmers()
+        dense = fcgr(seq)
+        assert (dense == fcgr.fcgr_reference(seq)).all()
+
+        fcgr_compact = FCGR(k=k, use_canonical_kmers=True, canonical_layout="compact")
+        compact = fcgr_compact(seq)
+        assert compact.shape == ((4**k + (4**(k//2) if k % 2 == 0 else 0)) // 2,)
+        assert (fcgr_compact.compact2dense(compact) == dense).all()
+
+def test_dtypes_and_sparse(tmp_path):
+    "compact dtypes and sparse output give the same FCGR"
+    seq = "".join(random.choice("ACGTN") for _ in range(5_000))
+    k = 6
+    expected = FCGR(k=k)(seq)
+    for dtype in ("float32","uint32","uint16"):
+        fcgr = FCGR(k=k, dtype=dtype)(seq)
+        assert fcgr.dtype == dtype
+        assert (fcgr == expected).all()
+
+    # integer dtypes saturate
+    assert FCGR(k=1, dtype="uint16")("A"*100_000).max() == 2**16-1
+
+    fcgr = FCGR(k=k, sparse=True)
+    sparse = fcgr(seq)
+    assert sparse == SparseFCGR.from_dense(expected)
+    assert (sparse.todense() == expected).all()
+    fcgr.save_img(sparse, path=tmp_path.joinpath("sparse.png"))
+
+    fcgr = FCGR(k=k, use_canonical_kmers=True, sparse=True)
+    assert (fcgr(seq).todense() == FCGR(k=k, use_canonical_kmers=True)(seq)).all()
+
+def test_pyramid():
+    "FCGRs for lower k by 2x2 sum-pooling are the same as counting again"
+    seq = "".join(random.choice("ACGTNN") for _ in range(5_000))
+    pyramid = FCGR(k=6).pyramid(seq, k_min=2)
+    assert sorted(pyramid) == [2,3,4,5,6]
+    for k, fcgr in pyramid.items():
+        assert (fcgr == FCGR(k=k)(seq)).all()
+
+def test_from_fasta(tmp_path):
+    "FCGRs from FASTA files (plain and gzipped, in small blocks) are the same as from the sequences"
+    import gzip
+    records = [(f"chr{j} description", "".join(random.choice("ACGTN") for _ in range(random.randint(0, 2_000))))
+               for j in range(5)]
+    fasta = "".join(f">{header}\n" + "".join(seq[i:i+60]+"\n" for i in range(0, len(seq), 60)) for header, seq in records)
+    path, path_gz = tmp_path.joinpath("genome.fa"), tmp_path.joinpath("genome.fa.gz")
+    path.write_text(fasta)
+    path_gz.write_bytes(gzip.compress(fasta.encode()))
+
+    fcgr = FCGR(k=4)
+    for p in (path, path_gz):
+        for block_size in (10, 1_000):
+            assert (fcgr.from_fasta(p, block_size=block_size) == sum(fcgr(seq) for _, seq in records)).all()
+            per_record = list(fcgr.from_fasta(p, per_record=True, block_size=block_size))
+            assert [id for id, _ in per_record] == [f"chr{j}" for j in range(5)]
+            for (_, chaos), (_, seq) in zip(per_record, records):
+                assert (chaos == fcgr(seq)).all()
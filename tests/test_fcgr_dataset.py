@@ -0,0 +1,46 @@
+import random
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from complexcgr import FCGR, FCGRDataset
+
+def _append(args):
+    path, start, seqs = args
+    fcgr = FCGR(k=4)
+    dataset = FCGRDataset(path)
+    for j, seq in enumerate(seqs):
+        dataset.append(fcgr(seq), id=f"seq{start+j}", metadata={"length": len(seq)})
+
+def test_dataset(tmp_path):
+    "FCGRs appended (by several processes) are read back by position and id"
+    path = tmp_path.joinpath("fcgrs.fcgr")
+    dataset = FCGRDataset.create(path, k=4, dtype="uint16")
+    assert len(dataset) == 0
+
+    seqs = ["".join(random.choice("ACGT") for _ in range(random.randint(10, 500))) for _ in range(20)]
+    tasks = [(path, start, seqs[start:start+5]) for start in range(0, 20, 5)]
+    with ProcessPoolExecutor(2) as pool:
+        list(pool.map(_append, tasks))
+
+    dataset = FCGRDataset(path)
+    assert len(dataset) == 20 and dataset[:].shape == (20, 16, 16)
+    fcgr = FCGR(k=4)
+    for j, seq in enumerate(seqs):
+        pos = dataset.position(f"seq{j}")
+        assert (dataset[pos] == fcgr(seq)).all()
+        assert dataset.metadata(pos) == {"length": len(seq)}
+    assert sorted(dataset.ids) == sorted(f"seq{j}" for j in range(20))
+
+    # views of the file, not copies
+    assert np.shares_memory(dataset[3:7], dataset.slots)
+
+def test_dataset_dtypes(tmp_path):
+    "integer datasets saturate, the shape can be set (e.g. FCGR with qualities)"
+    dataset = FCGRDataset.create(tmp_path.joinpath("u8.fcgr"), k=2, dtype="uint8")
+    dataset.extend(np.full((2,4,4), 300.), ids=["a","b"])
+    assert dataset.get("b").dtype == np.uint8 and (dataset.get("b") == 255).all()
+    assert dataset.metadata(0) == {}
+
+    dataset = FCGRDataset.create(tmp_path.joinpath("f32.fcgr"), k=2, dtype="float32", shape=(4,4,2))
+    fcgrs = np.random.rand(3,4,4,2)
+    dataset.extend(fcgrs, ids=["a","b","c"])
+    assert np.allclose(dataset[:], fcgrs.astype(np.float32))
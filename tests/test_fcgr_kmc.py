@@ -0,0 +1,105 @@
+import gzip
+import random
+import numpy as np
+from collections import Counter
+from complexcgr import FCGRKmc
+from complexcgr import fastx
+
+def write_dump(path, k):
+    "k-mer counts in the format of kmc_tools transform ... dump"
+    seq = "".join(random.choice("ACGT") for _ in range(20_000))
+    counts = Counter(seq[i:i+k] for i in range(len(seq)-k+1))
+    counts["A"*k] = 123_456_789 # counts with several digits
+    open_ = gzip.open if str(path).endswith(".gz") else open
+    with open_(path, "wt") as fp:
+        fp.write("".join(f"{kmer}\t{freq}\n" for kmer, freq in sorted(counts.items())))
+
+def test_fcgr_kmc(tmp_path, monkeypatch):
+    "bulk parser gives the same FCGR as the line by line parser, with lines split across blocks"
+    monkeypatch.setattr(fastx, "BLOCK_SIZE", 1_000)
+    k = 5
+    fcgr = FCGRKmc(k)
+    for name in ("dump.txt", "dump.txt.gz"):
+        path = tmp_path.joinpath(name)
+        write_dump(path, k)
+        assert (fcgr(path) == fcgr.fcgr_reference(path)).all()
+
+def write_kmc_database(path, counts, k, lut_prefix_length, n_bins=3, counter_size=4, signature_len=2):
+    "Write k-mer counts as a KMC database (format 0x200 of KMC 2 and 3), with the k-mers spread in several bins"
+    code = lambda kmer: int("".join(str("ACGT".index(n)) for n in kmer), 4) if kmer else 0
+    suffix_size = (k - lut_prefix_length) // 4
+    bins = [sorted(kmer for kmer in counts if code(kmer) % n_bins == b) for b in range(n_bins)]
+
+    luts, records, index = [], [], 0
+    for kmers in bins:
+        prefixes = [code(kmer[:lut_prefix_length]) for kmer in kmers]
+        luts.extend(index + sum(p < x for p in prefixes) for x in range(4**lut_prefix_length))
+        for kmer in kmers:
+            records.append(code(kmer[lut_prefix_length:]).to_bytes(suffix_size, "big") 
+                           + counts[kmer].to_bytes(counter_size, "little"))
+        index += len(kmers)
+
+    header = np.array([k, 0, counter_size, lut_prefix_length, signature_len, 1, 10**9], dtype="<u4").tobytes()
+    header += np.array([index], dtype="<u8").tobytes() + b"\x01" + bytes(23) + np.array([0x200], dtype="<u4").tobytes()
+    with open(f"{path}.kmc_pre", "wb") as fp:
+        fp.write(b"KMCP" + np.array(luts, dtype="<u8").tobytes())
+        fp.write(np.zeros(4**signature_len + 1, dtype="<u4").tobytes()) # signature map
+        fp.write(header + np.array([len(header)], dtype="<u4").tobytes() + b"KMCP")
+    with open(f"{path}.kmc_suf", "wb") as fp:
+        fp.write(b"KMCS" + b"".join(records) + b"KMCS")
+
+def test_fcgr_kmc_database(tmp_path):
+    "FCGR from a KMC database is the same as the one from its dump"
+    for k, lut_prefix_length in ((6,2), (9,1)):
+        seq = "".join(random.choice("ACGT") for _ in range(5_000))
+        counts = Counter(seq[i:i+k] for i in range(len(seq)-k+1))
+        counts["T"*k] = 70_000 # counters with several bytes
+        write_kmc_database(tmp_path.joinpath(f"db{k}"), counts, k, lut_prefix_length)
+        with open(tmp_path.joinpath(f"dump{k}.txt"), "w") as fp:
+            fp.write("".join(f"{kmer}\t{freq}\n" for kmer, freq in sorted(counts.items())))
+
+        fcgr = FCGRKmc(k)
+        expected = fcgr(tmp_path.joinpath(f"dump{k}.txt"))
+        assert (fcgr(tmp_path.joinpath(f"db{k}")) == expected).all()
+        assert (fcgr(tmp_path.joinpath(f"db{k}.kmc_pre")) == expected).all()
+
+def test_fcgr_kmc_canonical(tmp_path):
+    "canonical k-mers from a kmc dump"
+    k = 4
+    write_dump(tmp_path.joinpath("dump.txt"), k)
+    fcgr = FCGRKmc(k, use_canonical_kmers=True)
+    assert (fcgr(tmp_path.joinpath("dump.txt")) == fcgr.fcgr_reference(tmp_path.joinpath("dump.txt"))).all()
+
+def test_fcgr_kmc_database_bytes(tmp_path):
+    """KMC database written byte by byte (not with write_kmc_database): 5-mers, lut_prefix_length 1,
+    2 bins and 2-byte counters, with the k-mers AACGT:2, GTTTT:7 (bin 0), CCCCC:1, TACGT:300 (bin 1)"""
+    pre = bytes.fromhex(
+        "4b4d4350"                                          # KMCP
+        "0000000000000000 0100000000000000 0100000000000000 0200000000000000" # LUT bin 0, prefixes A,C,G,T
+        "0200000000000000 0200000000000000 0300000000000000 0300000000000000" # LUT bin 1
+        "00000000 01000000 00000000 01000000 00000000"      # signature map (4**1+1 bins)
+        "05000000 00000000 02000000 01000000 01000000"      # k, mode, counter_size, lut_prefix_length, signature_len
+        "01000000 e8030000"                                 # min_count, max_count
+        "0400000000000000"                                  # total_kmers
+        "00" + "00"*23 +                                    # both_strands, reserved
+        "00020000"                                          # version 0x200
+        "40000000"                                          # header_offset (64 bytes)
+        "4b4d4350"                                          # KMCP
+    )
+    suf = bytes.fromhex(
+        "4b4d4353"                                          # KMCS
+        "1b 0200"                                           # A|ACGT : 2
+        "ff 0700"                                           # G|TTTT : 7
+        "55 0100"                                           # C|CCCC : 1
+        "1b 2c01"                                           # T|ACGT : 300
+        "4b4d4353"                                          # KMCS
+    )
+    tmp_path.joinpath("db.kmc_pre").write_bytes(pre)
+    tmp_path.joinpath("db.kmc_suf").write_bytes(suf)
+
+    fcgr = FCGRKmc(5)
+    expected = np.zeros((2**5, 2**5))
+    for kmer, freq in {"AACGT": 2, "GTTTT": 7, "CCCCC": 1, "TACGT": 300}.items():
+        pos_x, pos_y = fcgr.kmer2pixel[kmer]
+        expected[int(pos_x)-1, int(pos_y)-1] = freq
+    assert (fcgr(tmp_path.joinpath("db")) == expected).all()
@@ -0,0 +1,134 @@
+import gzip
+import random
+import numpy as np
+from collections import defaultdict
+from complexcgr import FCGR
+from complexcgr import fcgr_samples as fcgr_samples_module
+from complexcgr.fcgr_samples import FCGRSamples
+from complexcgr.fastx import FastxReader
+
+def random_reads(n_reads, len_read):
+    reads = ["".join(random.choice("ACGTN") for _ in range(len_read)) for _ in range(n_reads)]
+    quals = [[random.randint(2,40) for _ in range(len_read)] for _ in range(n_reads)]
+    return reads, quals
+
+def write_fastq(path, reads, quals):
+    lines = []
+    for j, (read, qual) in enumerate(zip(reads, quals)):
+        # quality lines can also start with '@'
+        lines += [f"@read{j}", read, "+", "".join(chr(q+33) for q in qual)]
+    open_ = gzip.open if str(path).endswith(".gz") else open
+    with open_(path, "wt") as fp:
+        fp.write("\n".join(lines)+"\n")
+
+def test_fcgr_samples(tmp_path):
+    "FCGR of a fastq file (plain and gzipped) is the sum of the FCGRs of its reads"
+    k = 4
+    reads, quals = random_reads(200, 150)
+    write_fastq(tmp_path.joinpath("reads.fastq"), reads[:100], quals[:100])
+    write_fastq(tmp_path.joinpath("reads.fastq.gz"), reads[100:], quals[100:])
+
+    fcgr_samples = FCGRSamples(k)
+    fcgr = fcgr_samples([tmp_path.joinpath("reads.fastq"), tmp_path.joinpath("reads.fastq.gz")])
+    expected = sum(FCGR(k).fcgr_reference(read) for read in reads)
+    assert (fcgr == expected).all()
+
+def test_fcgr_samples_qualities(tmp_path):
+    "mean quality of each k-mer matches the dict-based implementation"
+    k = 3
+    reads, quals = random_reads(50, 100)
+    write_fastq(tmp_path.joinpath("reads.fastq"), reads, quals)
+
+    fcgr_samples = FCGRSamples(k)
+    fcgr = fcgr_samples(tmp_path.joinpath("reads.fastq"), consider_quality=True)
+
+    fcgr_samples.freq_kmer, fcgr_samples.qual_kmer = defaultdict(int), defaultdict(int)
+    for read, qual in zip(reads, quals):
+        fcgr_samples.count_kmers_qualities(read, qual)
+    for kmer, freq in fcgr_samples.freq_kmer.items():
+        pos_x, pos_y = fcgr_samples.kmer2pixel[kmer]
+        assert fcgr[pos_x-1, pos_y-1, 0] == freq
+        assert np.isclose(fcgr[pos_x-1, pos_y-1, 1], fcgr_samples.qual_kmer[kmer] / freq)
+
+def test_fastx_reader_fasta(tmp_path):
+    "records of a fasta file are joined across lines and blocks, and separated between records"
+    seqs = ["".join(random.choice("ACGT") for _ in range(500)) for _ in range(3)]
+    with open(tmp_path.joinpath("seqs.fa"), "w") as fp:
+        for j, seq in enumerate(seqs):
+            fp.write(f">seq{j}\n" + "\n".join(seq[i:i+60] for i in range(0, len(seq), 60)) + "\n")
+
+    batches = list(FastxReader(tmp_path.joinpath("seqs.fa"), block_size=128))
+    assert sum(batch.n_reads for batch in batches) == 3
+    assert b"".join(batch.seq.tobytes() for batch in batches) == b"\n" + b"\n".join(seq.encode() for seq in seqs)
+
+    k = 5
+    batches = FastxReader(tmp_path.joinpath("seqs.fa"), block_size=128, overlap=k-1)
+    fcgr = FCGR(k)
+    assert (sum(fcgr(batch.seq) for batch in batches) == sum(fcgr(seq) for seq in seqs)).all()
+
+def test_fcgr_samples_parallel(tmp_path, monkeypatch):
+    "counting with several processes (and splitting large files) gives the same FCGR"
+    monkeypatch.setattr(fcgr_samples_module, "SPLIT_SIZE", 10_000)
+    k = 4
+    reads, quals = random_reads(300, 100)
+    paths = [tmp_path.joinpath("reads.fastq"), tmp_path.joinpath("reads.fastq.gz")]
+    write_fastq(paths[0], reads[:200], quals[:200])
+    write_fastq(paths[1], reads[200:], quals[200:])
+
+    fcgr_samples = FCGRSamples(k)
+    assert len(fcgr_samples.split_tasks(paths, n_jobs=2)) > 2
+    for consider_quality in (False, True):
+        serial = fcgr_samples(paths, consider_quality=consider_quality)
+        parallel = fcgr_samples(paths, consider_quality=consider_quality, n_jobs=2)
+        assert (serial == parallel).all()
+
+def test_fcgr_samples_gzipped_without_suffix(tmp_path, monkeypatch):
+    "gzipped files are detected by their content, not their name, and never split"
+    monkeypatch.setattr(fcgr_samples_module, "SPLIT_SIZE", 10_000)
+    k = 4
+    reads, quals = random_reads(300, 150)
+    write_fastq(tmp_path.joinpath("reads.fastq.gz"), reads, quals)
+    path = tmp_path.joinpath("reads.fq")
+    tmp_path.joinpath("reads.fastq.gz").rename(path)
+    assert path.stat().st_size > 10_000
+
+    fcgr_samples = FCGRSamples(k)
+    assert fcgr_samples.split_tasks([path], n_jobs=2) == [(path, 0, None)]
+    expected = sum(FCGR(k).fcgr_reference(read) for read in reads)
+    assert (fcgr_samples(path) == expected).all()
+    assert (fcgr_samples(path, n_jobs=2) == expected).all()
+
+def test_fcgr_samples_canonical(tmp_path):
+    "canonical k-mers from reads"
+    k = 3
+    reads, quals = random_reads(50, 100)
+    write_fastq(tmp_path.joinpath("reads.fastq"), reads, quals)
+
+    fcgr = FCGRSamples(k, use_canonical_kmers=True, canonical_layout="compact")(tmp_path.joinpath("reads.fastq"))
+    expected = sum(FCGR(k, use_canonical_kmers=True, canonical_layout="compact")(read) for read in reads)
+    assert (fcgr == expected).all()
+
+def test_fcgr_samples_min_quality(tmp_path):
+    "k-mers with a nucleotide below the minimum quality are not counted"
+    k = 3
+    reads, quals = random_reads(50, 100)
+    write_fastq(tmp_path.joinpath("reads.fastq"), reads, quals)
+    fcgr = FCGRSamples(k)(tmp_path.joinpath("reads.fastq"), min_quality=20)
+
+    # replace the nucleotides with low quality by N
+    masked_reads = ["".join(n if q >= 20 else "N" for n, q in zip(read, qual)) for read, qual in zip(reads, quals)]
+    assert (fcgr == sum(FCGR(k)(read) for read in masked_reads)).all()
+
+def test_fcgr_samples_sample_fraction(tmp_path):
+    "sampled k-mers are rescaled to the expected counts, the others are empty"
+    k = 6
+    reads, quals = random_reads(300, 150)
+    write_fastq(tmp_path.joinpath("reads.fastq"), reads, quals)
+    exact = FCGRSamples(k)(tmp_path.joinpath("reads.fastq"), consider_quality=True)
+    sampled = FCGRSamples(k, sample_fraction=0.2)(tmp_path.joinpath("reads.fastq"), consider_quality=True)
+
+    kept = sampled[...,0] > 0
+    assert np.allclose(sampled[kept,0], exact[kept,0] / 0.2)
+    assert np.allclose(sampled[kept,1], exact[kept,1])
+    assert abs(sampled[...,0].sum() / exact[...,0].sum() - 1) < 0.25
+    assert (sampled[...,0] == FCGR(k, sample_fraction=0.2)("\n".join(reads))).all()
@@ -0,0 +1,25 @@
+import random
+import numpy as np
+from complexcgr import FCGR, FCGRScanner
+
+def test_fcgr_scanner():
+    "FCGR of each window is the same as computing it from scratch"
+    seq = "".join(random.choice("ACGTN") for _ in range(3_000))
+    k, window = 3, 500
+    fcgr = FCGR(k)
+    for step in (1, 70, 499, 500, 700):
+        scanner = FCGRScanner(k, window=window, step=step)
+        starts = []
+        for start, window_fcgr in scanner(seq):
+            assert (window_fcgr == fcgr(seq[start:start+window])).all()
+            starts.append(start)
+        assert starts == list(range(0, len(seq)-window+1, step))
+
+def test_fcgr_scanner_distance():
+    "distance to a reference FCGR updated at each step"
+    seq = "".join(random.choice("ACGT") for _ in range(3_000))
+    k, window = 4, 1_000
+    reference = FCGR(k)(seq) * window / len(seq)
+    scanner = FCGRScanner(k, window=window, step=100)
+    for (start, distance), (_, window_fcgr) in zip(scanner(seq, reference=reference), scanner(seq)):
+        assert np.isclose(distance, np.linalg.norm(window_fcgr - reference))
@@ -33,4 +33,39 @@ def test_cgr_decode():
     assert cgr.decode(N=1,x=-1,y=1) == "C"
     assert cgr.decode(N=1,x=-1,y=-1) == "G"
     assert cgr.decode(N=1,x=1,y=-1) == "T"
-    assert cgr.decode(N=4,x=3,y=-9) == "ACGT"
\ No newline at end of file
+    assert cgr.decode(N=4,x=3,y=-9) == "ACGT"
+
+def test_encode_decode_long_sequence():
+    "bit-packed codec matches the nucleotide by nucleotide one, also for custom coordinates"
+    import random
+    from complexcgr.icgr import Coord
+    custom = dict(A=Coord(-1,-1),C=Coord(1,-1),G=Coord(1,1),T=Coord(-1,1))
+    for coords in (None, custom):
+        cgr = iCGR(coords)
+        for length in (0, 1, 9, 1_001):
+            seq = "".join(random.choice("ACGT") for _ in range(length))
+            encode = cgr.encode(seq)
+            assert encode == cgr.encode_reference(seq)
+            assert cgr.decode(*encode) == seq
+            assert cgr.decode_reference(*encode) == seq
+
+    seq = "".join(random.choice("ACGT") for _ in range(1_000_000))
+    assert cgr.decode(*cgr.encode(seq)) == seq
+
+
+def test_encode_decode_many():
+    "bulk codec matches encode for each k-mer"
+    import random
+    import numpy as np
+    cgr = iCGR()
+    kmers = ["".join(random.choice("ACGT") for _ in range(32)) for _ in range(100)]
+    x, y = cgr.encode_many(np.array(kmers, dtype="S32"))
+    assert [(int(a), int(b)) for a, b in zip(x, y)] == [cgr.encode(kmer)[1:] for kmer in kmers]
+    assert cgr.decode_many(x, y, 32).astype(str).tolist() == kmers
+
+def test_decode_numpy_integers():
+    "decode accepts NumPy integers, e.g. the output of encode_many"
+    import numpy as np
+    cgr = iCGR()
+    x, y = cgr.encode_many(["ACGTTG", "GGCATA"])
+    assert [cgr.decode(np.int64(6), a, b) for a, b in zip(x, y)] == ["ACGTTG", "GGCATA"]
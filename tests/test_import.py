@@ -0,0 +1,21 @@
+import sys
+import subprocess
+
+def test_import_is_light():
+    "importing complexcgr (and using FCGR) does not load matplotlib, Bio, PIL or tqdm"
+    code = (
+        "import sys, complexcgr\n"
+        "from complexcgr import FCGR, CGR\n"
+        "FCGR(k=3)('ACGTNACGT')\n"
+        "print(','.join(m for m in ('matplotlib','Bio','PIL','tqdm') if m in sys.modules))\n"
+    )
+    loaded = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.strip()
+    assert loaded == ""
+
+def test_exports():
+    "classes using matplotlib/PIL/tqdm in some methods are exported too"
+    import complexcgr
+    from complexcgr.complexfcgr import ComplexFCGR
+    from complexcgr.fcgr_samples import FCGRSamples
+    assert complexcgr.ComplexFCGR is ComplexFCGR
+    assert complexcgr.FCGRSamples is FCGRSamples
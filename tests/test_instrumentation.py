@@ -0,0 +1,62 @@
+import os
+import random
+from complexcgr import FCGR
+from complexcgr.fcgr_samples import FCGRSamples
+from complexcgr.instrumentation import Recorder, Callback, ProgressBar, get_instrument
+from tests.test_fcgr_samples import random_reads, write_fastq
+
+def test_recorder():
+    "stages of FCGR are recorded only inside the context"
+    seq = "".join(random.choice("ACGT") for _ in range(10_000))
+    fcgr = FCGR(k=4)
+    assert get_instrument().enabled is False
+
+    with Recorder() as recorder:
+        fcgr(seq)
+        fcgr(seq)
+    assert set(recorder.stats) == {"kmers", "counting", "pixels"}
+    assert recorder.stats["kmers"]["bases"] == 2*len(seq)
+    assert recorder.stats["pixels"]["calls"] == 2
+    assert get_instrument().enabled is False
+
+    events = []
+    with Callback(events.append):
+        fcgr(seq)
+    assert [event.stage for event in events] == ["kmers", "counting", "pixels"]
+    assert all(event.seconds >= 0 for event in events)
+
+def test_recorder_samples(tmp_path, monkeypatch):
+    "bytes and reads read from fastq files, also from other processes"
+    from complexcgr import fcgr_samples
+    monkeypatch.setattr(fcgr_samples, "SPLIT_SIZE", 10_000)
+    reads, quals = random_reads(300, 100)
+    path = tmp_path.joinpath("reads.fastq")
+    write_fastq(path, reads, quals)
+
+    fcgr = FCGRSamples(k=3)
+    for n_jobs in (1, 2):
+        with Recorder() as recorder:
+            fcgr(path, n_jobs=n_jobs)
+        assert recorder.stats["io"]["n_bytes"] == os.path.getsize(path)
+        assert recorder.stats["io"]["reads"] == 300
+        assert recorder.stats["kmers"]["bases"] == 300*100
+
+    with ProgressBar(disable=True):
+        fcgr(path)
+
+def test_recorder_blocks(tmp_path, monkeypatch):
+    "with several blocks of k-mers each base is counted once"
+    from complexcgr import kmers, fcgr_samples
+    monkeypatch.setattr(kmers, "BLOCK_SIZE", 100)
+    monkeypatch.setattr(fcgr_samples, "BLOCK_SIZE", 100)
+    seq = "".join(random.choice("ACGT") for _ in range(1_050))
+    with Recorder() as recorder:
+        FCGR(k=6)(seq)
+    assert recorder.stats["kmers"]["bases"] == len(seq)
+
+    reads, quals = random_reads(5, 1_050)
+    path = tmp_path.joinpath("reads.fastq")
+    write_fastq(path, reads, quals)
+    with Recorder() as recorder:
+        FCGRSamples(k=6)(path)
+    assert recorder.stats["kmers"]["bases"] == 5*1_050
@@ -0,0 +1,41 @@
+import random
+import numpy as np
+from collections import Counter
+from complexcgr import kmers
+
+def test_count_kmers_blocks(monkeypatch):
+    "counting by blocks gives the same counts as counting each k-mer"
+    monkeypatch.setattr(kmers, "BLOCK_SIZE", 100)
+    k = 3
+    seq = "".join(random.choice("ACGTN") for _ in range(1_000))
+    counts = kmers.count_kmers(seq, k)
+
+    expected = Counter(seq[i:i+k] for i in range(len(seq)-k+1) if "N" not in seq[i:i+k])
+    for kmer, code in zip(("AAA","ACG","TTT","GCA"),(0,6,63,36)):
+        assert counts[code] == expected[kmer]
+    assert counts.sum() == sum(expected.values())
+
+def test_count_kmers_lowercase():
+    "soft-masked nucleotides are counted as uppercase ones"
+    assert (kmers.count_kmers("acgtNACGT", 2) == kmers.count_kmers("ACGTNACGT", 2)).all()
+
+def test_sliding_min():
+    values = np.random.randint(0, 40, size=1_000)
+    for k in (1, 3, 7, 1_000):
+        expected = [values[i:i+k].min() for i in range(len(values)-k+1)]
+        assert (kmers.sliding_min(values, k) == expected).all()
+
+def test_frac_sample():
+    "FracMinHash keeps about a fraction of the k-mers, the same ones for any input"
+    codes = np.arange(4**8)
+    for fraction in (0.01, 0.1, 0.5):
+        kept = kmers.frac_sample(codes, fraction)
+        assert abs(kept.mean() - fraction) < 0.02
+        assert (kmers.sample_table(8, fraction) == kept).all()
+        assert (kmers.frac_sample(codes[::-1], fraction) == kept[::-1]).all()
+    assert kmers.frac_sample(codes, 1).all()
+
+    seq = "".join(random.choice("ACGTN") for _ in range(5_000))
+    sampled = kmers.count_kmers(seq, 5, sample_fraction=0.25)
+    counts = kmers.count_kmers(seq, 5)
+    assert (sampled == np.where(kmers.sample_table(5, 0.25), counts, 0)).all()